@@ -0,0 +1,218 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+from scipy.spatial import Delaunay
+
+# half of the 3x3 block of neighbouring cells, every unordered pair of cells is visited once
+HALF_SHELL = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+FULL_SHELL = tuple((dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+
+def no_pairs():
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+def cell_neighbours(query_cells, cells, shell):
+    '''
+        Hashes the integer cells (one row per particle) and, for every (dx, dy) in shell, yields
+        (dx, dy, i, j) where j runs over the particles in the cell of query particle i shifted
+        by (dx, dy). Only occupied cells are stored which keeps sparse systems in large boxes cheap.
+    '''
+    # one spare row on either side so that a y offset of -1 can never alias another column
+    rows = max(cells[:, 1].max(), query_cells[:, 1].max()) + 3
+    keys = cells[:, 0] * rows + cells[:, 1]
+    order = np.argsort(keys, kind="stable")
+    occupied, start, counts = np.unique(keys[order], return_index=True, return_counts=True)
+
+    for dx, dy in shell:
+        neighbour = (query_cells[:, 0] + dx) * rows + query_cells[:, 1] + dy
+        slot = np.minimum(np.searchsorted(occupied, neighbour), len(occupied) - 1)
+        found = np.flatnonzero(occupied[slot] == neighbour)
+        found_counts = counts[slot[found]]
+
+        # pair particle i with every particle of its neighbouring cell
+        i = np.repeat(found, found_counts)
+        offsets = np.arange(len(i)) - np.repeat(np.cumsum(found_counts) - found_counts, found_counts)
+        j = order[np.repeat(start[slot[found]], found_counts) + offsets]
+        yield dx, dy, i, j
+
+def cell_pairs(positions, cutoff : float):
+    '''
+        Returns every pair of rows (i, j), i < j, whose positions are closer than cutoff.
+
+        Positions are hashed into a uniform grid of square cells with side cutoff, so only
+        particles in the same or neighbouring cells are compared.
+    '''
+    positions = np.asarray(positions, dtype=float)
+    if (len(positions) < 2 or cutoff <= 0):
+        return no_pairs()
+
+    cells = np.floor((positions - positions.min(axis=0)) / cutoff).astype(np.int64)
+    first, second = [], []
+    for dx, dy, i, j in cell_neighbours(cells, cells, HALF_SHELL):
+        if (dx == 0 and dy == 0):
+            keep = i < j
+            i, j = i[keep], j[keep]
+        first.append(i)
+        second.append(j)
+
+    i = np.concatenate(first)
+    j = np.concatenate(second)
+    close = np.sum((positions[i] - positions[j]) ** 2, axis=1) < cutoff ** 2
+    i, j = i[close], j[close]
+    return np.minimum(i, j), np.maximum(i, j)
+
+def cross_pairs(queries, positions, cutoff : float):
+    '''
+        Returns every pair (q, p) of a row of queries and a row of positions closer than cutoff.
+    '''
+    queries = np.asarray(queries, dtype=float).reshape(-1, 2)
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    if (len(queries) == 0 or len(positions) == 0 or cutoff <= 0):
+        return no_pairs()
+
+    origin = np.minimum(queries.min(axis=0), positions.min(axis=0))
+    query_cells = np.floor((queries - origin) / cutoff).astype(np.int64)
+    cells = np.floor((positions - origin) / cutoff).astype(np.int64)
+    first, second = [], []
+    for dx, dy, i, j in cell_neighbours(query_cells, cells, FULL_SHELL):
+        first.append(i)
+        second.append(j)
+
+    i = np.concatenate(first)
+    j = np.concatenate(second)
+    close = np.sum((queries[i] - positions[j]) ** 2, axis=1) < cutoff ** 2
+    return i[close], j[close]
+
+def place_disks(rng, n : int, radius, region, inside = None, positions = None, radii = None,
+                batch = None, patience = 5):
+    '''
+        Samples up to n non-overlapping disks inside the rectangle region = (xmin, ymin, xmax, ymax).
+
+        radius is either a number or a function (rng, count) -> radii. inside is an optional
+        function (positions) -> boolean mask that restricts the region further. positions and radii
+        are disks that are already placed and must not be overlapped.
+
+        Candidates are drawn in batches and checked with the cell hash against the accepted disks
+        and each other, so placement is close to linear in n. Sampling stops once n disks are
+        placed or patience batches in a row added nothing, which happens when the target density
+        cannot be reached. Returns the (m, 2) positions and (m,) radii of the m <= n new disks.
+    '''
+    xmin, ymin, xmax, ymax = region
+    placed = np.zeros((0, 2)) if positions is None else np.asarray(positions, dtype=float).reshape(-1, 2)
+    placed_radii = np.zeros(0) if radii is None else np.asarray(radii, dtype=float).reshape(-1)
+    existing = len(placed)
+
+    failures = 0
+    while (len(placed) - existing < n and failures < patience):
+        wanted = n - (len(placed) - existing)
+        count = batch if batch is not None else max(2 * wanted, 64)
+        r = np.broadcast_to(radius(rng, count) if callable(radius) else radius, (count,)).astype(float)
+        # about one candidate per diameter sized cell, denser batches only produce more overlaps
+        if (batch is None and r.max() > 0):
+            r = r[:max(64, int((xmax - xmin) * (ymax - ymin) / (2 * r.max()) ** 2))]
+        candidates = rng.uniform((xmin, ymin), (xmax, ymax), size=(len(r), 2))
+
+        # keep the whole disk inside the region
+        keep = ((candidates[:, 0] - r > xmin) & (candidates[:, 0] + r < xmax) &
+                (candidates[:, 1] - r > ymin) & (candidates[:, 1] + r < ymax))
+        if (inside is not None):
+            keep &= np.asarray(inside(candidates), dtype=bool)
+        candidates, r = candidates[keep], r[keep]
+
+        # against the disks that are already placed
+        if (len(placed) > 0 and len(candidates) > 0):
+            q, p = cross_pairs(candidates, placed, r.max() + placed_radii.max())
+            hit = np.sum((candidates[q] - placed[p]) ** 2, axis=1) < (r[q] + placed_radii[p]) ** 2
+            keep = np.ones(len(candidates), dtype=bool)
+            keep[q[hit]] = False
+            candidates, r = candidates[keep], r[keep]
+
+        # against each other, the later candidate of an overlapping pair is dropped
+        if (len(candidates) > 1):
+            i, j = cell_pairs(candidates, 2 * r.max())
+            hit = np.sum((candidates[i] - candidates[j]) ** 2, axis=1) < (r[i] + r[j]) ** 2
+            keep = np.ones(len(candidates), dtype=bool)
+            keep[j[hit]] = False
+            candidates, r = candidates[keep], r[keep]
+
+        candidates, r = candidates[:wanted], r[:wanted]
+        failures = failures + 1 if len(candidates) == 0 else 0
+        placed = np.concatenate([placed, candidates])
+        placed_radii = np.concatenate([placed_radii, r])
+
+    return placed[existing:], placed_radii[existing:]
+
+class BroadPhase(ABC):
+    '''
+        Broad phase of the collision detection in ParticleDynamics.
+
+        candidate_pairs returns two index arrays (i, j) into the rows of positions. Every pair of
+        overlapping particles has to be in the result, the narrow phase removes the rest.
+    '''
+    @abstractmethod
+    def candidate_pairs(self, positions, radii):
+        pass
+
+class DelaunayBroadPhase(BroadPhase):
+    '''
+        Uses the edges of the Delaunay triangulation of the positions as candidate pairs.
+        Rebuilt from scratch every step, kept for comparison with the cell list broad phases.
+    '''
+    def candidate_pairs(self, positions, radii):
+        positions = np.asarray(positions, dtype=float)
+        n = len(positions)
+        if (n < 2):
+            return no_pairs()
+        if (n < 3):
+            return np.array([0]), np.array([1])
+
+        simplices = np.sort(Delaunay(positions).simplices, axis=1)
+        edges = np.concatenate([simplices[:, [0, 1]], simplices[:, [0, 2]], simplices[:, [1, 2]]])
+        edges = np.unique(edges, axis=0)
+        return edges[:, 0], edges[:, 1]
+
+class CellListBroadPhase(BroadPhase):
+    '''
+        Uniform grid (cell list) broad phase.
+
+        cell_size defaults to the largest diameter, which is the furthest apart two particles can
+        be while still overlapping.
+    '''
+    def __init__(self, cell_size = None):
+        self.cell_size = cell_size
+
+    def cutoff(self, radii):
+        if (self.cell_size is not None):
+            return self.cell_size
+        return 2 * np.max(radii) if len(radii) > 0 else 0
+
+    def candidate_pairs(self, positions, radii):
+        return cell_pairs(positions, self.cutoff(radii))
+
+class VerletListBroadPhase(CellListBroadPhase):
+    '''
+        Verlet neighbour lists built on top of the cell list.
+
+        The list holds every pair closer than the cell list cutoff plus skin. It stays valid
+        until some particle has moved more than skin / 2 from where it was when the list was
+        built, only then is it rebuilt. rebuilds counts how often that happened.
+    '''
+    def __init__(self, skin : float, cell_size = None):
+        super().__init__(cell_size)
+        self.skin = skin
+        self.reference = None
+        self.pairs = no_pairs()
+        self.rebuilds = 0
+
+    def needs_rebuild(self, positions):
+        if (self.reference is None or self.reference.shape != positions.shape):
+            return True
+        displacement = np.max(np.sum((positions - self.reference) ** 2, axis=1)) if len(positions) > 0 else 0
+        return displacement > (self.skin / 2) ** 2
+
+    def candidate_pairs(self, positions, radii):
+        positions = np.asarray(positions, dtype=float)
+        if (self.needs_rebuild(positions)):
+            self.pairs = cell_pairs(positions, self.cutoff(radii) + self.skin)
+            self.reference = positions.copy()
+            self.rebuilds += 1
+        return self.pairs
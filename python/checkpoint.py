@@ -0,0 +1,80 @@
+import os
+import pickle
+import time
+
+# checkpoint-<number>.pkl, numbered in the order they were written
+PREFIX = "checkpoint-"
+SUFFIX = ".pkl"
+
+def list_checkpoints(directory : str):
+    '''
+        Returns the checkpoints in directory, oldest first.
+    '''
+    if (not os.path.isdir(directory)):
+        return []
+    names = [name for name in os.listdir(directory) if name.startswith(PREFIX) and name.endswith(SUFFIX)]
+    names.sort(key=lambda name: int(name[len(PREFIX):-len(SUFFIX)]))
+    return [os.path.join(directory, name) for name in names]
+
+def latest_checkpoint(directory : str):
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if len(checkpoints) > 0 else None
+
+def save_checkpoint(state, directory : str, keep = 3) -> str:
+    '''
+        Pickles state into the next checkpoint of directory and deletes all but the newest keep.
+
+        The snapshot is written to a temporary file, synced and renamed into place, so a run that
+        dies while writing leaves the previous checkpoints intact. Returns the new path.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    latest = latest_checkpoint(directory)
+    number = int(os.path.basename(latest)[len(PREFIX):-len(SUFFIX)]) + 1 if latest is not None else 0
+    path = os.path.join(directory, PREFIX + str(number).zfill(6) + SUFFIX)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+    for old in list_checkpoints(directory)[:-keep]:
+        os.remove(old)
+    return path
+
+def load_checkpoint(checkpoint : str):
+    '''
+        Loads a checkpoint file, or the newest checkpoint when given a directory.
+    '''
+    if (os.path.isdir(checkpoint)):
+        latest = latest_checkpoint(checkpoint)
+        if (latest is None):
+            raise FileNotFoundError("no checkpoints in " + checkpoint)
+        checkpoint = latest
+    with open(checkpoint, "rb") as f:
+        return pickle.load(f)
+
+class Checkpointer:
+    '''
+        Decides when a long run writes a checkpoint and writes it.
+
+        A checkpoint is due every interval seconds of wall clock time and, if every is given,
+        every `every` frames. Checkpoints go to directory, only the newest keep are kept.
+    '''
+    def __init__(self, directory : str, interval = 300.0, every = None, keep = 3):
+        self.directory = directory
+        self.interval = interval
+        self.every = every
+        self.keep = keep
+        self.last = time.monotonic()
+        self.saved = []
+
+    def due(self, frame : int) -> bool:
+        if (self.every is not None and frame % self.every == 0):
+            return True
+        return self.interval is not None and time.monotonic() - self.last >= self.interval
+
+    def save(self, state) -> str:
+        path = save_checkpoint(state, self.directory, self.keep)
+        self.saved.append(path)
+        self.last = time.monotonic()
+        return path
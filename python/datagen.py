@@ -1,31 +1,57 @@
-from simulation import CoarseDiffsion, BrownianMotion, ParticleDynamics
+from simulation import Simulation, CoarseDiffsion, ArrayBrownianMotion, ParticleDynamics
 from simdata import BoundaryCondition
-import numpy as np
+from checkpoint import Checkpointer
 
 import sys
-import random
+import shutil
+
+# seconds of wall clock time between checkpoints, and how many are kept
+CHECKPOINT_INTERVAL = 300
+CHECKPOINT_KEEP = 2
+
+def resume(output_path):
+	# finishes an interrupted run from the newest checkpoint next to its output
+	directory = output_path + ".checkpoints"
+	Simulation.resume(directory, Checkpointer(directory, CHECKPOINT_INTERVAL, keep=CHECKPOINT_KEEP))
+	shutil.rmtree(directory, ignore_errors=True)
 
 def main():
-	if (len(sys.argv) != 8):
-		print("Improper Number of commandline arguments: $ python datagen.py <wierner/collision> <width> <height> <num particles> <timesteps> <dt> <output path>")
+	if (len(sys.argv) == 3 and sys.argv[1].lower() == "resume"):
+		resume(sys.argv[2])
+		return None
+	if (len(sys.argv) not in (8, 9)):
+		print("Improper Number of commandline arguments: $ python datagen.py <wierner/collision> <width> <height> <num particles> <timesteps> <dt> <output path> [error]")
 		return None
 	sim = None
 	sim_size = (int(sys.argv[2]), int(sys.argv[3]))
 	if (sys.argv[1].lower() == "wierner"):
 		diffusion_rate = .1
-		sim = BrownianMotion(sim_size, diffusion_rate, BoundaryCondition.REFLECTIVE)
-		for n in range(int(sys.argv[4])):
-			sim.add_particle(random.uniform(0,sim_size[0]), random.uniform(0,sim_size[1]))
+		sim = ArrayBrownianMotion(sim_size, diffusion_rate, BoundaryCondition.REFLECTIVE)
+		sim.add_particles(sim.rng.uniform((0, 0), sim_size, size=(int(sys.argv[4]), 2)))
 	elif (sys.argv[1].lower() == "collision"):
-		sim = ParticleDynamics(sim_size, BoundaryCondition.REFLECTIVE)
-		for n in range(int(sys.argv[4])):
-			sim.add_particle(.1, [random.uniform(0,sim_size[0]), random.uniform(0,sim_size[1])], [random.uniform(-1,1), random.uniform(-1,1)])
+		sim = ParticleDynamics(sim_size, BoundaryCondition.REFLECTIVE, compact=True)
+		placed = sim.place_particles(int(sys.argv[4]), .1, lambda rng, n: rng.uniform(-1, 1, (n, 2)))
+		if (placed < int(sys.argv[4])):
+			print("Only " + str(placed) + " particles fit into the simulation")
 	else:
 		print(sys.argv[1] + " is not a proper argument")
 
-	sim.get_data(sys.argv[7], int(sys.argv[5]), float(sys.argv[6]))
+	# a .bin output path selects the binary trajectory format, .trz the compressed one, whose
+	# positions are kept to within error (by default a millionth of the box)
+	error = float(sys.argv[8]) if len(sys.argv) == 9 else None
+	layout = "particle"
+	if (sys.argv[7].endswith(".bin")):
+		layout = "binary"
+	elif (sys.argv[7].endswith(".trz")):
+		layout = "compressed"
+	# checkpoints are written next to the output while the run lasts, see resume
+	directory = sys.argv[7] + ".checkpoints"
+	checkpoints = Checkpointer(directory, CHECKPOINT_INTERVAL, keep=CHECKPOINT_KEEP)
+	sim.get_data(sys.argv[7], int(sys.argv[5]), float(sys.argv[6]), layout=layout, checkpoints=checkpoints, error=error)
+	shutil.rmtree(directory, ignore_errors=True)
 
 
-# $ python datagen.py <wierner/collision> <width> <height> <num particles> <timesteps> <dt> <output path>
+# $ python datagen.py <wierner/collision> <width> <height> <num particles> <timesteps> <dt> <output path> [error]
+# $ python datagen.py resume <output path>
 if __name__ == '__main__':
 	main()
\ No newline at end of file
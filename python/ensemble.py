@@ -0,0 +1,77 @@
+import os
+import multiprocessing as mp
+
+import numpy as np
+
+# set in every worker process by the pool initializer, so the factory and observable are never pickled
+replica_factory = None
+replica_observe = None
+
+def init_worker(factory, observe):
+    global replica_factory, replica_observe
+    replica_factory = factory
+    replica_observe = observe
+
+def run_replica(task):
+    index, seed = task
+    rng = np.random.default_rng(seed)
+    sim = replica_factory(rng)
+    return index, np.asarray(replica_observe(sim, rng))
+
+class Ensemble:
+    '''
+        Runs independent realizations (replicas) of a simulation over a process pool.
+
+        factory(rng) builds one replica from its own numpy.random.Generator, pass the generator on as
+        the seed of the simulation (ArrayBrownianMotion(..., seed = rng), place_particles(..., seed = rng)).
+        observe(sim, rng) runs it and returns the replica's output, an array (or number) that is
+        sent back to the parent instead of the whole history.
+
+        Replica k always gets the k-th stream spawned from numpy.random.SeedSequence(seed), outputs
+        come back in replica order and are reduced in that order, so results are bitwise
+        reproducible for a given root seed whatever the number of workers. workers = 1 runs
+        everything in this process.
+    '''
+    def __init__(self, factory, observe, replicas : int, seed = None, workers = None):
+        self.factory = factory
+        self.observe = observe
+        self.replicas = replicas
+        self.seed = np.random.SeedSequence(seed)
+        # spawned once, spawning again would hand out new streams
+        self.streams = self.seed.spawn(replicas)
+        self.workers = workers if workers is not None else os.cpu_count()
+
+    def outputs(self):
+        '''
+            Yields (replica index, output) in replica order as the replicas finish.
+        '''
+        tasks = list(enumerate(self.streams))
+        if (self.workers <= 1):
+            init_worker(self.factory, self.observe)
+            for task in tasks:
+                yield run_replica(task)
+            return
+
+        # fork keeps the factory and observable in the workers without pickling them
+        context = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+        with context.Pool(self.workers, initializer=init_worker, initargs=(self.factory, self.observe)) as pool:
+            chunksize = max(1, self.replicas // (4 * self.workers))
+            for result in pool.imap(run_replica, tasks, chunksize):
+                yield result
+
+    def statistics(self):
+        '''
+            Returns the elementwise mean and (sample) variance of the outputs over all replicas,
+            accumulated one replica at a time with Welford's algorithm.
+        '''
+        mean, m2, count = None, None, 0
+        for index, output in self.outputs():
+            count += 1
+            if (mean is None):
+                mean = np.zeros(output.shape)
+                m2 = np.zeros(output.shape)
+            delta = output - mean
+            mean += delta / count
+            m2 += delta * (output - mean)
+        variance = m2 / (count - 1) if count > 1 else np.zeros_like(mean)
+        return mean, variance
@@ -10,8 +10,6 @@ from simdata import BoundaryCondition
 import numpy as np
 import matplotlib.pyplot as plt
 
-import random
-
 def coarse_example_1D():
     #define sim parameters
     sim_size = (21,1)
@@ -93,22 +91,10 @@ def collisions_example():
     # sim.add_particle(.5, [7, 5], [-1, 0])
     # sim.add_particle(.5, [4.9, 5], [1, 0])
     # sim.add_particle(.5, [5.1, 5], [0, 1])
-    for i in range(500):
-        # added = sim.add_particle(.1,[random.uniform(4,6), random.uniform(4,6)], [random.uniform(-1,1), random.uniform(-1,1)])
-        # added = sim.add_particle(.1,[random.uniform(4,6), random.uniform(4,6)], [random.gauss(0,1) + .1, .1 + random.gauss(0,1)])
-        x = random.uniform(0,10)
-        y = random.uniform(0,10)
-        d = ((x - 5) ** 2 + (y - 5) ** 2) ** .5
-
-        while not (d <= 4):
-            x = random.uniform(0,10)
-            y = random.uniform(0,10)
-            d = ((x - 5) ** 2 + (y - 5) ** 2) ** .5
-        # print(d, x, y)
-        
-        added = sim.add_particle(.1,[x, y], [random.gauss(0,1) + .1, .1 + random.gauss(0,1)])
-
-        # sim.add_particle(.1,[random.uniform(0,1), random.uniform(0,1)], [0,0])
+    # 500 non-overlapping particles inside a circle of radius 4
+    placed = sim.place_particles(500, .1, lambda rng, n: rng.normal(.1, 1, (n, 2)),
+                                 inside = lambda p: np.sum((p - 5) ** 2, axis = 1) <= 16)
+    print(placed, "particles placed")
     sim.display()
 
     # sim.simulate(12, 1)
@@ -0,0 +1,84 @@
+import numpy as np
+
+def select_collisions(i, j, priority):
+    '''
+        Picks the collisions to resolve when a particle is in several overlapping pairs.
+
+        Pairs are ranked by priority (largest first), ties are broken by (i, j). Going down that
+        ranking a pair is kept unless one of its particles is already in a kept pair, so every
+        particle takes part in at most one collision per step. Remaining overlaps are picked up
+        on the next step. Returns a boolean mask over the pairs.
+    '''
+    chosen = np.zeros(len(i), dtype=bool)
+    if (len(i) == 0):
+        return chosen
+    n = max(i.max(), j.max()) + 1
+    rank = np.empty(len(i), dtype=np.int64)
+    rank[np.lexsort((j, i, -priority))] = np.arange(len(i))
+
+    # a pair that is the best remaining pair of both of its particles is exactly the pair the
+    # sequential scan would keep, so whole rounds of them can be taken at once
+    active = np.ones(len(i), dtype=bool)
+    while (np.any(active)):
+        best = np.full(n, len(i), dtype=np.int64)
+        np.minimum.at(best, i[active], rank[active])
+        np.minimum.at(best, j[active], rank[active])
+        won = active & (best[i] == rank) & (best[j] == rank)
+        chosen |= won
+
+        taken = np.zeros(n, dtype=bool)
+        taken[i[won]] = True
+        taken[j[won]] = True
+        active &= ~(taken[i] | taken[j])
+    return chosen
+
+def resolve_collisions(positions, velocities, radii, i, j, dt : float):
+    '''
+        Narrow phase of ParticleDynamics, resolves the overlapping pairs among the candidates (i, j).
+
+        positions are the projected positions at the end of the step, they and velocities are
+        updated in place. For every overlapping pair the time since contact is estimated from the
+        overlap and the approach speeds (capped at dt), both particles are moved back to the
+        contact point, the normal components of their velocities are exchanged (elastic collision,
+        equal masses) and they are moved forward again with the new velocities.
+        Returns the number of collisions resolved.
+    '''
+    if (len(i) == 0):
+        return 0
+    normal = positions[j] - positions[i]
+    dist = np.sqrt(np.sum(normal ** 2, axis=1))
+    overlap = (dist < radii[i] + radii[j]) & (dist > 0)
+    i, j, normal, dist = i[overlap], j[overlap], normal[overlap], dist[overlap]
+
+    unit = normal / dist[:, None]
+    van = np.sum(unit * velocities[i], axis=1)
+    vbn = np.sum(unit * velocities[j], axis=1)
+    speed = np.abs(van) + np.abs(vbn)
+    moving = speed > 0
+    i, j, dist, unit, speed = i[moving], j[moving], dist[moving], unit[moving], speed[moving]
+    t_intercept = np.minimum((radii[i] + radii[j] - dist) / speed, dt)
+
+    chosen = select_collisions(i, j, t_intercept)
+    i, j, t_intercept, unit = i[chosen], j[chosen], t_intercept[chosen][:, None], unit[chosen]
+    va, vb = velocities[i], velocities[j]
+
+    # exact positions when they collided
+    a_prev = positions[i] - va * t_intercept
+    b_prev = positions[j] - vb * t_intercept
+
+    # calculate the velocity after the collision, keeping the end of step normal if the
+    # contact points coincide
+    normal = b_prev - a_prev
+    length = np.sqrt(np.sum(normal ** 2, axis=1))[:, None]
+    unit = np.where(length > 0, normal / np.where(length > 0, length, 1), unit)
+    tangent = np.stack([-unit[:, 1], unit[:, 0]], axis=1)
+    van = np.sum(unit * va, axis=1)[:, None]
+    vat = np.sum(tangent * va, axis=1)[:, None]
+    vbn = np.sum(unit * vb, axis=1)[:, None]
+    vbt = np.sum(tangent * vb, axis=1)[:, None]
+
+    velocities[i] = vat * tangent + vbn * unit
+    velocities[j] = vbt * tangent + van * unit
+    positions[i] = a_prev + velocities[i] * t_intercept
+    positions[j] = b_prev + velocities[j] * t_intercept
+    return len(i)
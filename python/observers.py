@@ -0,0 +1,181 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from broadphase import cell_pairs
+
+class Observer(ABC):
+    '''
+        Measures a running simulation, see Simulation.run.
+
+        observe(sim, time) is called with the simulation every `every` steps, starting with the
+        initial state, and result() returns what was collected. Observers read the particle
+        positions from sim.simdata.get_positions() (rows ordered like get_ids()) so they work with
+        every particle based simulation.
+    '''
+    def __init__(self, every = 1):
+        self.every = every
+
+    @abstractmethod
+    def observe(self, sim, time : float):
+        pass
+
+    @abstractmethod
+    def result(self):
+        pass
+
+def bin_positions(positions, bins : (int, int), extent : (float, float, float, float)):
+    '''
+        Counts the (N, 2) positions on a grid of bins = (columns, rows) cells spanning
+        extent = (xmin, ymin, xmax, ymax). Returns a (rows, columns) array of counts, laid out like
+        CoarseDiffsion.data, positions outside the extent are ignored.
+    '''
+    columns, rows = bins
+    xmin, ymin, xmax, ymax = extent
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    x = np.floor((positions[:, 0] - xmin) * (columns / (xmax - xmin))).astype(np.int64)
+    y = np.floor((positions[:, 1] - ymin) * (rows / (ymax - ymin))).astype(np.int64)
+    # a particle exactly on the far wall belongs to the last cell
+    x[positions[:, 0] == xmax] = columns - 1
+    y[positions[:, 1] == ymax] = rows - 1
+    inside = (x >= 0) & (x < columns) & (y >= 0) & (y < rows)
+    counts = np.bincount(y[inside] * columns + x[inside], minlength=rows * columns)
+    return counts.reshape(rows, columns)
+
+class ConcentrationField(Observer):
+    '''
+        Bins the particles onto a grid every `every` steps instead of keeping their trajectories.
+
+        bins = (columns, rows) defaults to one cell per unit of the simulation size, and extent to
+        the whole box, so the result lines up with CoarseDiffsion.simulate(...)[::every] for a grid of
+        the same size. Each particle counts as weight. result() is a (T, rows, columns) array.
+    '''
+    def __init__(self, bins : (int, int) = None, extent : (float, float, float, float) = None,
+                 every = 1, weight = 1.0):
+        super().__init__(every)
+        self.bins = bins
+        self.extent = extent
+        self.weight = weight
+        self.frames = []
+        self.times = []
+
+    def observe(self, sim, time : float):
+        if (self.bins is None):
+            self.bins = (int(round(sim.size[0])), int(round(sim.size[1])))
+        if (self.extent is None):
+            self.extent = (0, 0, sim.size[0], sim.size[1])
+        counts = bin_positions(sim.simdata.get_positions(), self.bins, self.extent)
+        self.frames.append(self.weight * counts)
+        self.times.append(time)
+
+    def result(self):
+        if (len(self.frames) == 0):
+            return np.zeros((0, 0, 0))
+        return np.stack(self.frames)
+
+def ids_of(sim):
+    ids = sim.simdata.get_ids()
+    if (isinstance(ids, np.ndarray)):
+        return ids
+    return np.fromiter(ids, dtype=np.int64, count=len(ids))
+
+class MeanSquaredDisplacement(Observer):
+    '''
+        Mean squared displacement of the particles from where they were at the first observation.
+
+        Particles are matched by id, so particles that were removed (absorbed) or added later are
+        left out. Positions are the ones stored by the simulation, with reflective walls the
+        displacement is folded back into the box and the MSD levels off once it reaches the box size.
+        result() returns the (T,) observation times and the (T,) MSD.
+    '''
+    def __init__(self, every = 1):
+        super().__init__(every)
+        self.reference_ids = None
+        self.reference = None
+        self.times = []
+        self.msd = []
+
+    def displacements(self, sim):
+        ids = ids_of(sim)
+        positions = sim.simdata.get_positions()
+        if (self.reference is None):
+            order = np.argsort(ids, kind="stable")
+            self.reference_ids = ids[order]
+            self.reference = positions[order].copy()
+        slot = np.minimum(np.searchsorted(self.reference_ids, ids), max(len(self.reference_ids) - 1, 0))
+        known = np.flatnonzero(self.reference_ids[slot] == ids) if len(self.reference_ids) > 0 else slot[:0]
+        return positions[known] - self.reference[slot[known]]
+
+    def observe(self, sim, time : float):
+        displacement = self.displacements(sim)
+        self.times.append(time)
+        self.msd.append(np.mean(np.sum(displacement ** 2, axis=1)) if len(displacement) > 0 else 0.0)
+
+    def result(self):
+        return np.array(self.times), np.array(self.msd)
+
+class DiffusionCoefficient(MeanSquaredDisplacement):
+    '''
+        Running estimate of the diffusion coefficient from the mean squared displacement.
+
+        After every observation the least squares slope of MSD = 2 * dims * D * t through the origin
+        is updated from two running sums, so no history is needed. result() returns the (T,)
+        observation times and the (T,) estimate of D after each of them (nan until t > 0).
+    '''
+    def __init__(self, every = 1, dims = 2):
+        super().__init__(every)
+        self.dims = dims
+        self.sum_tm = 0.0
+        self.sum_tt = 0.0
+        self.estimates = []
+
+    def observe(self, sim, time : float):
+        super().observe(sim, time)
+        self.sum_tm += time * self.msd[-1]
+        self.sum_tt += time * time
+        self.estimates.append(self.sum_tm / (2 * self.dims * self.sum_tt) if self.sum_tt > 0 else np.nan)
+
+    def coefficient(self) -> float:
+        return self.estimates[-1] if len(self.estimates) > 0 else np.nan
+
+    def result(self):
+        return np.array(self.times), np.array(self.estimates)
+
+class RadialDistribution(Observer):
+    '''
+        Pair correlation function g(r) averaged over the observations.
+
+        Only pairs closer than r_max are looked at, they are found with the cell list of
+        broadphase.cell_pairs so an observation costs O(N) instead of O(N ** 2). Counts are
+        normalized by an ideal gas of the same density in the (walled, not periodic) box, which
+        has fewer pairs at distance r than an infinite one by a factor
+        1 - 2 r (W + H) / (pi W H) + r ** 2 / (pi W H), valid for r_max < min(W, H).
+        result() returns the (bins,) bin centers and g(r).
+    '''
+    def __init__(self, r_max : float, bins = 100, every = 1):
+        super().__init__(every)
+        self.edges = np.linspace(0, r_max, bins + 1)
+        self.counts = np.zeros(bins)
+        # expected number of pairs per unit area summed over the observations
+        self.density = 0.0
+        self.size = None
+
+    def observe(self, sim, time : float):
+        positions = np.asarray(sim.simdata.get_positions(), dtype=float)
+        n = len(positions)
+        if (n < 2):
+            return
+        i, j = cell_pairs(positions, self.edges[-1])
+        r = np.sqrt(np.sum((positions[i] - positions[j]) ** 2, axis=1))
+        self.counts += np.histogram(r, self.edges)[0]
+        self.density += n * (n - 1) / 2 / (sim.size[0] * sim.size[1])
+        self.size = sim.size
+
+    def result(self):
+        centers = (self.edges[1:] + self.edges[:-1]) / 2
+        shells = np.pi * (self.edges[1:] ** 2 - self.edges[:-1] ** 2)
+        if (self.density == 0):
+            return centers, np.zeros(len(centers))
+        width, height = self.size
+        walls = 1 - 2 * centers * (width + height) / (np.pi * width * height) + centers ** 2 / (np.pi * width * height)
+        return centers, self.counts / (self.density * shells * walls)
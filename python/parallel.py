@@ -0,0 +1,254 @@
+import os
+import threading
+import weakref
+import multiprocessing as mp
+import multiprocessing.connection
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from simulation import ParticleDynamics, collide
+from simdata import BoundaryCondition
+from broadphase import BroadPhase, CellListBroadPhase
+
+# arrays that live in shared memory, next_* receive the results of a step before they are copied back
+SHARED = (("positions", 2, np.float64), ("velocities", 2, np.float64), ("accelerations", 2, np.float64),
+          ("radii", 0, np.float64), ("owner", 0, np.int64),
+          ("next_positions", 2, np.float64), ("next_velocities", 2, np.float64))
+
+# dt, halo width, stop flag
+PARAMS = 3
+
+def attach(names, n):
+    '''
+        Maps the shared memory blocks of a ParallelParticleDynamics into numpy arrays.
+    '''
+    blocks, arrays = {}, {}
+    for name, width, dtype in SHARED:
+        blocks[name] = shared_memory.SharedMemory(name=names[name])
+        shape = (n, width) if width else (n,)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=blocks[name].buf)
+    blocks["params"] = shared_memory.SharedMemory(name=names["params"])
+    arrays["params"] = np.ndarray((PARAMS,), dtype=np.float64, buffer=blocks["params"].buf)
+    return blocks, arrays
+
+def slab_of(x, size : (float, float), workers : int):
+    return np.clip((x // (size[0] / workers)).astype(np.int64), 0, workers - 1)
+
+def worker(rank : int, workers : int, names, n : int, size : (float, float),
+           boundary_condition : BoundaryCondition, broad_phase : BroadPhase, barrier):
+    '''
+        Body of one worker process, it owns the particles in slab rank of the box.
+
+        Every step the worker gathers its own particles plus the ghost particles of the other
+        slabs that lie within the halo of its borders, runs the serial collision step on them and
+        writes back only the particles it owns. After all workers are done reading, each one
+        copies its results into the current state and reassigns the owner of particles that
+        crossed into another slab.
+    '''
+    blocks, arrays = attach(names, n)
+    positions, velocities, accelerations = arrays["positions"], arrays["velocities"], arrays["accelerations"]
+    radii, owner, params = arrays["radii"], arrays["owner"], arrays["params"]
+    x0 = rank * size[0] / workers
+    x1 = (rank + 1) * size[0] / workers
+    try:
+        while (True):
+            barrier.wait()
+            dt, halo, stop = params
+            if (stop):
+                break
+
+            mine = owner == rank
+            ghost = ~mine & (positions[:, 0] > x0 - halo) & (positions[:, 0] < x1 + halo)
+            local = np.flatnonzero(mine | ghost)
+            p = positions[local] + velocities[local] * dt + 1/2 * accelerations[local] * dt ** 2
+            v = velocities[local].copy()
+            collide(p, v, radii[local], size, dt, boundary_condition, broad_phase)
+
+            own = mine[local]
+            rows = local[own]
+            arrays["next_positions"][rows] = p[own]
+            arrays["next_velocities"][rows] = v[own]
+            barrier.wait()
+
+            # migration, particles that left the slab are handed to their new owner
+            positions[rows] = arrays["next_positions"][rows]
+            velocities[rows] = arrays["next_velocities"][rows]
+            owner[rows] = slab_of(positions[rows, 0], size, workers)
+            barrier.wait()
+    except threading.BrokenBarrierError:
+        # another worker failed or the run was torn down, the parent reports it
+        pass
+    except BaseException:
+        # wake the parent and the other workers instead of leaving them at the barrier
+        barrier.abort()
+        raise
+    finally:
+        for block in blocks.values():
+            block.close()
+
+def watch(processes, barrier):
+    '''
+        Breaks the barrier as soon as a worker dies with an error, including the ones that are
+        killed before they can abort it themselves (out of memory, signals).
+    '''
+    running = list(processes)
+    while (running):
+        ended = multiprocessing.connection.wait([process.sentinel for process in running])
+        for process in [process for process in running if process.sentinel in ended]:
+            process.join()
+            if (process.exitcode != 0):
+                barrier.abort()
+                return
+            running.remove(process)
+
+def release(blocks, processes):
+    '''
+        Stops the workers and unlinks the shared memory blocks of a ParallelParticleDynamics that
+        was never closed, when it is garbage collected or at interpreter exit.
+    '''
+    for process in processes:
+        if (process.is_alive()):
+            process.terminate()
+    for block in blocks.values():
+        block.unlink()
+
+class ParallelParticleDynamics(ParticleDynamics):
+    '''
+        ParticleDynamics split over several worker processes by spatial domain decomposition.
+
+        The box is cut into equal vertical slabs, one per worker. Particle state lives in
+        multiprocessing.shared_memory, every worker steps the particles of its slab and reads the
+        particles of the neighbouring slabs that are close enough to its borders to collide with
+        them (halo or ghost particles). Particles migrate to another worker when they cross a
+        slab border. Pairs that straddle a border are resolved by both workers with the same
+        rules, so results are statistically equivalent to ParticleDynamics but not bitwise equal.
+
+        Workers start on the first step and are stopped by close() (or by adding particles).
+        simdata is backed by the shared arrays while the workers run. If a worker fails, the step
+        waiting for it raises RuntimeError and the workers and shared memory are released.
+    '''
+    def __init__(self, size : (float, float), boundary_condition : BoundaryCondition, workers = None,
+                 broad_phase : BroadPhase = None):
+        super().__init__(size, boundary_condition, compact=True,
+                         broad_phase=broad_phase if broad_phase is not None else CellListBroadPhase())
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.blocks = None
+        self.processes = []
+
+    def __getstate__(self):
+        # checkpoints hold the particles only, the workers are started again on the next step
+        state = dict(self.__dict__)
+        for name in ("blocks", "processes", "barrier", "params", "finalizer"):
+            state.pop(name, None)
+        state["blocks"] = None
+        state["processes"] = []
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_particle(self, radius : float, position : [float], velocity : [float]):
+        self.close()
+        return super().add_particle(radius, position, velocity)
+
+    def place_particles(self, n : int, radius, velocity = (0, 0), region = None, inside = None, seed = None):
+        self.close()
+        return super().place_particles(n, radius, velocity, region, inside, seed)
+
+    def start(self):
+        n = self.simdata.count
+        self.blocks = {}
+        arrays = {}
+        for name, width, dtype in SHARED:
+            shape = (n, width) if width else (n,)
+            self.blocks[name] = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 8))
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=self.blocks[name].buf)
+        self.blocks["params"] = shared_memory.SharedMemory(create=True, size=PARAMS * 8)
+        self.params = np.ndarray((PARAMS,), dtype=np.float64, buffer=self.blocks["params"].buf)
+        self.params[:] = 0
+
+        for name in ("positions", "velocities", "accelerations", "radii"):
+            arrays[name][:] = getattr(self.simdata, name)[:n]
+            setattr(self.simdata, name, arrays[name])
+        arrays["owner"][:] = slab_of(arrays["positions"][:, 0], self.size, self.workers)
+
+        names = {name: block.name for name, block in self.blocks.items()}
+        self.barrier = mp.Barrier(self.workers + 1)
+        self.processes = [mp.Process(target=worker, daemon=True,
+                                     args=(rank, self.workers, names, n, self.size,
+                                           self.boundary_condition, self.broad_phase, self.barrier))
+                          for rank in range(self.workers)]
+        for process in self.processes:
+            process.start()
+        threading.Thread(target=watch, args=(self.processes, self.barrier), daemon=True).start()
+        self.finalizer = weakref.finalize(self, release, self.blocks, self.processes)
+
+    def wait(self):
+        '''
+            Meets the workers at the barrier, raises RuntimeError (after releasing everything) if
+            one of them failed.
+        '''
+        try:
+            self.barrier.wait()
+        except threading.BrokenBarrierError:
+            for process in self.processes:
+                process.join(1)
+            codes = [process.exitcode for process in self.processes]
+            self.shutdown()
+            raise RuntimeError("a ParallelParticleDynamics worker failed, exit codes " + str(codes)) from None
+
+    def shutdown(self):
+        '''
+            Moves the particles back into private arrays and releases the workers and the shared memory.
+        '''
+        for name in ("positions", "velocities", "accelerations", "radii"):
+            setattr(self.simdata, name, getattr(self.simdata, name).copy())
+        del self.params
+        self.finalizer.detach()
+        for process in self.processes:
+            if (process.is_alive()):
+                process.terminate()
+            process.join()
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = None
+        self.processes = []
+
+    def close(self):
+        '''
+            Stops the workers and moves the particles back into private arrays.
+        '''
+        if (self.blocks is None):
+            return
+        self.params[2] = 1
+        self.wait()
+        for process in self.processes:
+            process.join()
+        self.shutdown()
+
+    def step(self, dt : float):
+        if (self.simdata.count == 0):
+            return
+        if (self.blocks is None):
+            self.start()
+        n = self.simdata.count
+        speed = np.max(np.sqrt(np.sum(self.simdata.velocities[:n] ** 2, axis=1)))
+        acc = np.max(np.sqrt(np.sum(self.simdata.accelerations[:n] ** 2, axis=1)))
+        # a ghost can reach an owned particle if both travel towards each other
+        self.params[0] = dt
+        self.params[1] = 2 * np.max(self.simdata.radii[:n]) + 2 * (speed * dt + 1/2 * acc * dt ** 2)
+        for i in range(3):
+            self.wait()
+
+    def get_owners(self):
+        '''
+            Returns the worker that owns every particle, rows ordered like get_ids().
+        '''
+        if (self.blocks is None):
+            return slab_of(self.simdata.positions[:self.simdata.count, 0], self.size, self.workers)
+        return np.ndarray((self.simdata.count,), dtype=np.int64, buffer=self.blocks["owner"].buf).copy()
@@ -1,6 +1,10 @@
 import math
 import sys
+
+import numpy as np
+
 import segment_tree
+import trajectory
 
 
 """
@@ -29,33 +33,29 @@ def main():
     bottom = float(sys.argv[5])
     start_time = float(sys.argv[6])
     end_time = float(sys.argv[7])
-    data = list()
-
-    with open(input_filename) as file:
-        simulation_width, simulation_height = file.readline().split(' ')
-        num_timesteps, dt = file.readline().split(' ')
-        num_timesteps = int(num_timesteps)
-        dt = float(dt)
-        num_particles = int(file.readline())
-        for particle in range(0, num_particles):
-            positions = file.readline().strip().split(' ')
-            positions = [x[1:-1] for x in positions]  # drop the parentheses
-            positions = [x.split(',') for x in positions]
-            positions = [segment_tree.Point(float(x[0]), float(x[1])) for x in positions]
-            data.append(positions)
+    # text (particle-major or time-major), binary and compressed trajectories all read as (frames, N, 2)
+    (simulation_width, simulation_height), num_timesteps, dt, positions = trajectory.read_trajectory(input_filename)
+
+    # the tree of timestep i holds the segments from frame i - 1 to frame i, only the frames of
+    # the trees in the queried range are read (compressed files only decode the chunks holding them)
+    timestamps = [(i*dt, None) for i in range(1, int(num_timesteps))]
+    timestep_index_range = get_timesteps_from_range(timestamps, start_time, end_time, dt)
+    first, last = timestep_index_range[0], timestep_index_range[1]
+    frames = np.asarray(positions[first:last + 1])
 
     segmented_data = list()  # a list of tuples of the form (timestamp, segment tree)
-    for i in range(1, int(num_timesteps)):
-        segments = [segment_tree.Segment(data[x][i-1], data[x][i], i) for x in range(num_particles)]
-        segmented_data.append((i*dt, segment_tree.SegmentTree(segments)))
+    for i in range(first + 1, last + 1):
+        # segment x of the tree is particle x moving from frame i - 1 to frame i
+        segments = np.stack((frames[i-1-first], frames[i-first]), axis=1)
+        segmented_data.append((i*dt, segment_tree.FlatSegmentTree(segments)))
 
     # Execute a single query for now... TODO: do something more exciting with the data.
-    timestep_index_range = get_timesteps_from_range(segmented_data, start_time, end_time, dt)
-    total_segments = set()
-    for timestep, tree in segmented_data[timestep_index_range[0]:timestep_index_range[1]]:
-        total_segments |= tree.window_query(left, right, top, bottom)
+    # every (timestep, particle) segment found counts once, like the Segment objects of SegmentTree did
+    total_segments = 0
+    for timestep, tree in segmented_data:
+        total_segments += len(tree.window_query(left, right, top, bottom))
 
-    print(f'{len(total_segments)} distinct particles observed in query box between time {start_time} and time {end_time}')
+    print(f'{total_segments} distinct particles observed in query box between time {start_time} and time {end_time}')
 
 
 if __name__ == '__main__':
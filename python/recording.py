@@ -0,0 +1,52 @@
+import numpy as np
+
+class History:
+    '''
+        Preallocated storage for the frames recorded by simulate.
+
+        One frame is kept every record_every steps, written into a single (frames, *shape) array
+        instead of a list of copies. With capacity only the last capacity frames are kept (ring
+        buffer). With filename the array is a memory mapped .npy file, so histories larger than
+        RAM are paged out to disk and can be opened again with numpy.load(filename, mmap_mode="r").
+    '''
+    def __init__(self, shape, steps : int, record_every = 1, capacity = None, filename = None, dtype = float):
+        self.record_every = record_every
+        frames = -(-steps // record_every)
+        length = frames if capacity is None else min(frames, capacity)
+        shape = (length,) + tuple(shape)
+        if (filename is not None):
+            self.data = np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+        else:
+            self.data = np.empty(shape, dtype=dtype)
+        self.count = 0
+
+    def due(self, step : int) -> bool:
+        return step % self.record_every == 0
+
+    def next_frame(self):
+        '''
+            Returns the array of the next frame to be written in place.
+        '''
+        frame = self.data[self.count % len(self.data)]
+        self.count += 1
+        return frame
+
+    def record(self, frame):
+        self.next_frame()[...] = frame
+
+    def steps(self):
+        '''
+            Step number of each frame returned by result().
+        '''
+        return np.arange(max(self.count - len(self.data), 0), self.count) * self.record_every
+
+    def result(self):
+        '''
+            The recorded frames in chronological order.
+        '''
+        if (isinstance(self.data, np.memmap)):
+            self.data.flush()
+        if (self.count <= len(self.data)):
+            return self.data[:self.count]
+        start = self.count % len(self.data)
+        return np.concatenate([self.data[start:], self.data[:start]])
@@ -2,6 +2,8 @@ import random
 import sys
 from typing import List
 
+import numpy as np
+
 sys.setrecursionlimit(999)
 
 """
@@ -107,3 +109,91 @@ class SegmentTree:
             retval |= self.right.window_query(left, right, top, bottom)
 
         return retval
+
+
+"""
+A flattened segment tree over an (N, 2, 2) array of segment endpoints, segments[i] = ((x0, y0), (x1, y1)).
+
+Segments are ordered by median splits of their midpoints along the wider axis, so the tree is
+balanced (depth about log2(N / leaf_size)) and every node covers a contiguous run of that order.
+Nodes live in flat arrays: the run [start, end), the two children (-1 for a leaf) and the bounds of
+the segments below it, no Segment or Point objects are created.
+"""
+class FlatSegmentTree:
+    def __init__(self, segments, leaf_size: int = 16):
+        segments = np.asarray(segments, dtype=float)
+        assert segments.ndim == 3 and segments.shape[1:] == (2, 2)
+        assert len(segments) > 0
+        min_x = segments[:, :, 0].min(axis=1)
+        max_x = segments[:, :, 0].max(axis=1)
+        min_y = segments[:, :, 1].min(axis=1)
+        centers = segments.mean(axis=1)
+
+        order = np.arange(len(segments))
+        starts, ends, lefts, rights = list(), list(), list(), list()
+        stack = [(0, len(segments), -1, False)]
+        while stack:
+            start, end, parent, is_right = stack.pop()
+            node = len(starts)
+            starts.append(start)
+            ends.append(end)
+            lefts.append(-1)
+            rights.append(-1)
+            if parent >= 0:
+                (rights if is_right else lefts)[parent] = node
+            if end - start <= leaf_size:
+                continue
+            run = order[start:end]
+            spread = centers[run].max(axis=0) - centers[run].min(axis=0)
+            middle = (end - start) // 2
+            order[start:end] = run[np.argpartition(centers[run, int(spread[1] > spread[0])], middle)]
+            stack.append((start + middle, end, node, True))
+            stack.append((start, start + middle, node, False))
+
+        self.order = order
+        self.min_x = min_x[order]
+        self.max_x = max_x[order]
+        self.min_y = min_y[order]
+        self.start = np.array(starts)
+        self.end = np.array(ends)
+        self.left = np.array(lefts)
+        self.right = np.array(rights)
+
+        # bounds[node] holds the lowest and highest min_x, max_x and min_y of the segments below node,
+        # children always come after their parent, so they are filled bottom up in reverse
+        self.bounds = np.empty((len(starts), 6))
+        for node in range(len(starts) - 1, -1, -1):
+            if self.left[node] < 0:
+                start, end = starts[node], ends[node]
+                self.bounds[node] = (self.min_x[start:end].min(), self.min_x[start:end].max(),
+                                     self.max_x[start:end].min(), self.max_x[start:end].max(),
+                                     self.min_y[start:end].min(), self.min_y[start:end].max())
+            else:
+                children = self.bounds[[self.left[node], self.right[node]]]
+                self.bounds[node, 0::2] = children[:, 0::2].min(axis=0)
+                self.bounds[node, 1::2] = children[:, 1::2].max(axis=0)
+
+    """
+    Return the indices (into the segments the tree was built from) of the segments whose x extent lies
+    within [left, right] and whose min_y lies within [bottom, top], the test SegmentTree.window_query makes.
+    """
+    def window_query(self, left: float, right: float, top: float, bottom: float) -> np.ndarray:
+        found = list()
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            low_min_x, high_min_x, low_max_x, high_max_x, low_min_y, high_min_y = self.bounds[node]
+            if high_min_x < left or low_max_x > right or high_min_y < bottom or low_min_y > top:
+                continue
+            start, end = self.start[node], self.end[node]
+            if low_min_x >= left and high_max_x <= right and low_min_y >= bottom and high_min_y <= top:
+                found.append(self.order[start:end])
+            elif self.left[node] < 0:
+                inside = ((self.min_x[start:end] >= left) & (self.max_x[start:end] <= right)
+                          & (self.min_y[start:end] >= bottom) & (self.min_y[start:end] <= top))
+                found.append(self.order[start:end][inside])
+            else:
+                stack.append(self.right[node])
+                stack.append(self.left[node])
+
+        return np.concatenate(found) if found else np.empty(0, dtype=int)
@@ -8,6 +8,7 @@ Created on Fri Nov 17 21:32:02 2023
 from enum import Enum
 from abc import ABC, abstractmethod
 
+import numpy as np
 from scipy.spatial.distance import pdist
 
 class SimData(ABC):
@@ -103,6 +104,22 @@ class ParticleMap(SimData):
             return self.id - 1
         return False
 
+    def add_particles(self, radii, positions, velocities, accelerations = None):
+        '''
+            Adds n particles from (n,) radii and (n, dims) position / velocity arrays without any
+            overlap checks, returns the new ids.
+        '''
+        positions = np.asarray(positions, dtype=float).reshape(-1, len(self.size))
+        velocities = np.broadcast_to(np.asarray(velocities, dtype=float), positions.shape)
+        accelerations = np.zeros(positions.shape) if accelerations is None else np.broadcast_to(np.asarray(accelerations, dtype=float), positions.shape)
+        radii = np.broadcast_to(np.asarray(radii, dtype=float), (len(positions),))
+
+        ids = list(range(self.id, self.id + len(positions)))
+        for id, radius, position, velocity, acc in zip(ids, radii.tolist(), positions.tolist(), velocities.tolist(), accelerations.tolist()):
+            self.data[id] = Particle(radius, position, velocity, acc)
+        self.id += len(positions)
+        return ids
+
     def update_particle_pos(self, id : int, position : [float]):
         self.data[id].position = position
 
@@ -120,6 +137,240 @@ class ParticleMap(SimData):
     def get_data(self):
         return self.data.values()
 
+    def get_positions(self):
+        '''
+            Returns the positions as an (N, 2) array, rows ordered like get_ids().
+        '''
+        return np.array([particle.position for particle in self.data.values()], dtype=float).reshape(-1, 2)
+
+    def project(self, dt : float):
+        '''
+            Returns the positions after dt as an (N, dims) array, rows ordered like get_ids().
+        '''
+        projected = []
+        for particle in self.data.values():
+            projected.append([particle.velocity[p] * dt + 1/2 * particle.acc[p] * dt ** 2 + particle.position[p]
+                              for p in range(particle.dimensions)])
+        return np.array(projected, dtype=float).reshape(len(self.data), len(self.size))
+
+    def get_radii(self):
+        return np.array([particle.radius for particle in self.data.values()], dtype=float)
+
+    def get_velocities(self):
+        return np.array([list(particle.velocity) for particle in self.data.values()], dtype=float).reshape(len(self.data), len(self.size))
+
+    def update_particles(self, positions, velocities):
+        '''
+            Sets the position and velocity of every particle from (N, dims) arrays ordered like get_ids().
+        '''
+        for particle, position, velocity in zip(self.data.values(), positions.tolist(), velocities.tolist()):
+            particle.position = position
+            particle.velocity = velocity
+
+class ParticleView:
+    '''
+        Lightweight stand-in for a Particle stored in a ParticleArray.
+
+        Attributes read and write the particle's row of the store directly, position, velocity
+        and acc are numpy views so item assignment also goes straight into the arrays.
+    '''
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, row : int):
+        self.store = store
+        self.row = row
+
+    @property
+    def position(self):
+        return self.store.positions[self.row]
+
+    @position.setter
+    def position(self, position : [float]):
+        self.store.positions[self.row] = position
+
+    @property
+    def velocity(self):
+        return self.store.velocities[self.row]
+
+    @velocity.setter
+    def velocity(self, velocity : [float]):
+        self.store.velocities[self.row] = velocity
+
+    @property
+    def acc(self):
+        return self.store.accelerations[self.row]
+
+    @acc.setter
+    def acc(self, acc : [float]):
+        self.store.accelerations[self.row] = acc
+
+    @property
+    def radius(self):
+        return float(self.store.radii[self.row])
+
+    @radius.setter
+    def radius(self, radius : float):
+        self.store.radii[self.row] = radius
+
+    @property
+    def dimensions(self):
+        return self.store.positions.shape[1]
+
+    def copy(self):
+        return Particle(self.radius, self.position.tolist(), self.velocity.tolist(), self.acc.tolist())
+
+    def step(self, dt):
+        self.position += self.velocity * dt + 1/2 * self.acc * dt ** 2
+        self.velocity += self.acc * dt
+
+    def moving(self):
+        return bool(np.any(self.velocity != 0))
+
+    def overlap(self, pos : [float], radius : [float]):
+        return pdist([self.position, pos]) < self.radius + radius
+
+    def __str__(self):
+        return str(self.copy())
+
+class ParticleArray(SimData):
+    '''
+        Struct-of-arrays version of ParticleMap.
+
+        Positions, velocities, accelerations and radii are held in contiguous arrays with one row
+        per particle, ids are mapped to rows through an id -> row index. get_particle returns a
+        ParticleView so code written against ParticleMap keeps working, while whole-population
+        updates can work on the arrays directly.
+    '''
+    def __init__(self, size : (float, float), capacity = 16):
+        self.size = size
+        capacity = max(capacity, 1)
+        self.positions = np.zeros((capacity, len(size)))
+        self.velocities = np.zeros((capacity, len(size)))
+        self.accelerations = np.zeros((capacity, len(size)))
+        self.radii = np.zeros(capacity)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.index = {}
+        self.count = 0
+        self.id = 1
+
+    def copy(self):
+        copy = ParticleArray(self.size, self.count)
+        n = self.count
+        copy.positions[:n] = self.positions[:n]
+        copy.velocities[:n] = self.velocities[:n]
+        copy.accelerations[:n] = self.accelerations[:n]
+        copy.radii[:n] = self.radii[:n]
+        copy.ids[:n] = self.ids[:n]
+        copy.index = self.index.copy()
+        copy.count = n
+        copy.id = self.id
+        return copy
+
+    def reserve(self, capacity : int):
+        if (capacity <= len(self.radii)):
+            return
+        capacity = max(capacity, 2 * len(self.radii))
+        n = self.count
+        for name in ("positions", "velocities", "accelerations", "radii", "ids"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:n] = old[:n]
+            setattr(self, name, new)
+
+    def in_bounds(self, position: [float], radius = 0):
+        for p in range(len(self.size)):
+            if (position[p] <= radius or position[p] >= self.size[p] - radius):
+                return False
+        return True
+
+    def overlapping(self, radius : float, position : [float]):
+        n = self.count
+        if (n == 0):
+            return False
+        dist = np.sqrt(np.sum((self.positions[:n] - np.asarray(position)) ** 2, axis=1))
+        return bool(np.any(dist < self.radii[:n] + radius))
+
+    def add_particle(self, radius : float, position : [float], velocity : [float], acc : (float, float), check_overlap = False):
+        if (check_overlap and self.overlapping(radius, position)):
+            return False
+        if (self.in_bounds(position)):
+            self.reserve(self.count + 1)
+            row = self.count
+            self.positions[row] = position
+            self.velocities[row] = velocity
+            self.accelerations[row] = acc
+            self.radii[row] = radius
+            self.ids[row] = self.id
+            self.index[self.id] = row
+            self.count += 1
+            self.id += 1
+            return self.id - 1
+        return False
+
+    def add_particles(self, radii, positions, velocities, accelerations = None):
+        '''
+            Adds n particles from (n,) radii and (n, dims) position / velocity arrays without any
+            overlap checks, returns the new ids.
+        '''
+        positions = np.asarray(positions, dtype=float).reshape(-1, len(self.size))
+        n = len(positions)
+        self.reserve(self.count + n)
+        rows = slice(self.count, self.count + n)
+        self.positions[rows] = positions
+        self.velocities[rows] = velocities
+        self.accelerations[rows] = 0 if accelerations is None else accelerations
+        self.radii[rows] = radii
+
+        ids = np.arange(self.id, self.id + n, dtype=np.int64)
+        self.ids[rows] = ids
+        self.index.update(zip(ids.tolist(), range(self.count, self.count + n)))
+        self.count += n
+        self.id += n
+        return ids
+
+    def update_particle_pos(self, id : int, position : [float]):
+        self.positions[self.index[id]] = position
+
+    def update_particle_velocity(self, id: int, velocity : [float]):
+        self.velocities[self.index[id]] = velocity
+
+    def get_particle(self, id: int):
+        if (id in self.index):
+            return ParticleView(self, self.index[id])
+        return False
+
+    def get_ids(self):
+        return self.ids[:self.count]
+
+    def get_data(self):
+        return [ParticleView(self, row) for row in range(self.count)]
+
+    def get_positions(self):
+        '''
+            Returns the positions as an (N, 2) array, rows ordered like get_ids().
+        '''
+        return self.positions[:self.count]
+
+    def project(self, dt : float):
+        '''
+            Returns the positions after dt as an (N, dims) array, rows ordered like get_ids().
+        '''
+        n = self.count
+        return self.positions[:n] + self.velocities[:n] * dt + 1/2 * self.accelerations[:n] * dt ** 2
+
+    def get_radii(self):
+        return self.radii[:self.count]
+
+    def get_velocities(self):
+        return self.velocities[:self.count].copy()
+
+    def update_particles(self, positions, velocities):
+        '''
+            Sets the position and velocity of every particle from (N, dims) arrays ordered like get_ids().
+        '''
+        self.positions[:self.count] = positions
+        self.velocities[:self.count] = velocities
+
 class SimMap(SimData):
 
     def __init__(self, size : (float, float)):
@@ -161,6 +412,160 @@ class SimMap(SimData):
     def get_data(self):
         return self.data.values()
 
+    def get_positions(self):
+        '''
+            Returns the positions as an (N, 2) array, rows ordered like get_ids().
+        '''
+        return np.array(list(self.data.values()), dtype=float).reshape(-1, 2)
+
+class SimArray(SimData):
+    '''
+        Array backed version of SimMap.
+
+        Positions are held in one contiguous (N, 2) float array so the whole population
+        can be moved with a single numpy operation. Rows are kept in insertion order, so ids
+        are sorted and an id is mapped to its row by binary search.
+
+        remove_particles only marks rows as dead, the arrays are compacted once more than
+        compact_fraction of the rows are dead. Until then positions and ids still hold the dead
+        rows (alive tells them apart), get_ids and get_data only return living particles.
+    '''
+
+    def __init__(self, size : (float, float), capacity = 16, compact_fraction = .25):
+        self.size = size
+        self.positions = np.zeros((max(capacity, 1), 2))
+        self.ids = np.zeros(max(capacity, 1), dtype=np.int64)
+        self.alive = np.ones(max(capacity, 1), dtype=bool)
+        self.count = 0
+        self.dead = 0
+        self.compact_fraction = compact_fraction
+
+        self.id = 1
+
+    def copy(self):
+        c = SimArray(self.size, self.count, self.compact_fraction)
+        c.positions[:self.count] = self.positions[:self.count]
+        c.ids[:self.count] = self.ids[:self.count]
+        c.alive[:self.count] = self.alive[:self.count]
+        c.count = self.count
+        c.dead = self.dead
+        c.id = self.id
+        return c
+
+    def clear(self):
+        self.count = 0
+        self.dead = 0
+
+    def reserve(self, capacity : int):
+        if (capacity <= len(self.positions)):
+            return
+        capacity = max(capacity, 2 * len(self.positions))
+        positions = np.zeros((capacity, 2))
+        positions[:self.count] = self.positions[:self.count]
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[:self.count] = self.ids[:self.count]
+        alive = np.ones(capacity, dtype=bool)
+        alive[:self.count] = self.alive[:self.count]
+        self.positions = positions
+        self.ids = ids
+        self.alive = alive
+
+    def row(self, id : int):
+        row = int(np.searchsorted(self.ids[:self.count], id))
+        if (row < self.count and self.ids[row] == id and self.alive[row]):
+            return row
+        return None
+
+    def in_bounds(self, positions):
+        positions = np.asarray(positions)
+        return ((positions[..., 0] > 0) & (positions[..., 0] < self.size[0]) &
+                (positions[..., 1] > 0) & (positions[..., 1] < self.size[1]))
+
+    def add_particle(self, xpos : float, ypos : float):
+        if (xpos > 0 and xpos < self.size[0] and ypos > 0 and ypos < self.size[1]):
+            self.reserve(self.count + 1)
+            self.positions[self.count] = (xpos, ypos)
+            self.ids[self.count] = self.id
+            self.alive[self.count] = True
+            self.count += 1
+            self.id += 1
+            return self.id - 1
+        return False
+
+    def add_particles(self, positions):
+        '''
+            Adds every in-bounds row of an (n, 2) array of positions, returns the new ids.
+        '''
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        positions = positions[self.in_bounds(positions)]
+        n = len(positions)
+        self.reserve(self.count + n)
+
+        ids = np.arange(self.id, self.id + n, dtype=np.int64)
+        self.positions[self.count:self.count + n] = positions
+        self.ids[self.count:self.count + n] = ids
+        self.alive[self.count:self.count + n] = True
+        self.count += n
+        self.id += n
+        return ids
+
+    def remove_particles(self, rows):
+        '''
+            Removes the particles in the given rows (an index array or boolean mask over the first count rows).
+        '''
+        rows = np.asarray(rows)
+        if (rows.dtype == bool):
+            rows = np.flatnonzero(rows)
+        rows = rows[self.alive[rows]]
+        self.alive[rows] = False
+        self.dead += len(rows)
+        if (self.dead > self.compact_fraction * self.count):
+            self.compact()
+
+    def compact(self):
+        keep = np.flatnonzero(self.alive[:self.count])
+        n = len(keep)
+        self.positions[:n] = self.positions[keep]
+        self.ids[:n] = self.ids[keep]
+        self.alive[:self.count] = True
+        self.count = n
+        self.dead = 0
+
+    def update_particle(self, id : int, xpos:float, ypos : float):
+        row = self.row(id)
+        if (xpos > 0 and xpos < self.size[0] and ypos > 0 and ypos < self.size[1] and row is not None):
+            self.positions[row] = (xpos, ypos)
+            return True
+        return False
+
+    def get_particle(self, id: int):
+        row = self.row(id)
+        if (row is not None):
+            return tuple(self.positions[row].tolist())
+        return False
+
+    def get_ids(self):
+        if (self.dead > 0):
+            return self.ids[:self.count][self.alive[:self.count]]
+        return self.ids[:self.count]
+
+    def get_data(self):
+        if (self.dead > 0):
+            return self.positions[:self.count][self.alive[:self.count]]
+        return self.positions[:self.count]
+
+    def get_positions(self):
+        '''
+            Returns the positions as an (N, 2) array, rows ordered like get_ids().
+        '''
+        return self.get_data()
+
+class Wall(Enum):
+    LEFT = 0
+    RIGHT = 1
+    BOTTOM = 2
+    TOP = 3
+
 class BoundaryCondition(Enum):
     REFLECTIVE = 0
     ABSORBTION = 1
\ No newline at end of file
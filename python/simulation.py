@@ -8,16 +8,21 @@ Created on Fri Nov 17 21:24:11 2023
 from abc import ABC, abstractmethod
 import random
 import math
+import heapq
 
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import matplotlib.animation as animation
 import numpy as np
-from scipy import signal
-from scipy.spatial import Delaunay
-from scipy.spatial.distance import pdist
+from scipy import signal, sparse
+from scipy.sparse.linalg import splu
 
-from simdata import SimMap, BoundaryCondition, Particle, ParticleMap
+from simdata import SimMap, SimArray, BoundaryCondition, Wall, Particle, ParticleMap, ParticleArray
+from broadphase import BroadPhase, CellListBroadPhase, place_disks
+from narrowphase import resolve_collisions
+from recording import History
+from trajectory import TrajectoryWriter
+from checkpoint import save_checkpoint, load_checkpoint
 
 class Simulation(ABC):
     '''
@@ -41,6 +46,68 @@ class Simulation(ABC):
     def get_data(self, filename : str, steps : int, dt : float):
         pass
 
+    def run(self, steps : int, dt : float, observers):
+        '''
+            Advances steps steps without recording the history. Every observer (see observers.py)
+            is shown the simulation every observer.every steps, starting with the initial state.
+            Returns the result() of each observer.
+        '''
+        for i in range(steps):
+            for observer in observers:
+                if (i % observer.every == 0):
+                    observer.observe(self, i * dt)
+            self.step(dt)
+        return [observer.result() for observer in observers]
+
+    def advance_frame(self, dt : float, **options):
+        self.step(dt)
+
+    def write_frame(self, writer):
+        writer.write(self.simdata.get_positions())
+
+    def write_frames(self, writer, steps : int, dt : float, start = 0, checkpoints = None, options = None):
+        '''
+            The loop of get_data: writes frames start to steps into writer (a TrajectoryWriter),
+            advancing by dt before every frame but the first. When checkpoints (a
+            checkpoint.Checkpointer) says so, the writer is flushed and the simulation, the writer
+            and the position in the loop are saved, see resume.
+        '''
+        options = options if options is not None else {}
+        with writer:
+            for i in range(start, steps + 1):
+                if (i > 0):
+                    self.advance_frame(dt, **options)
+                self.write_frame(writer)
+                if (checkpoints is not None and i < steps and checkpoints.due(i)):
+                    writer.flush()
+                    checkpoints.save({"simulation": self, "writer": writer, "frame": i + 1,
+                                      "steps": steps, "dt": dt, "options": options})
+
+    def checkpoint(self, directory : str, keep = 3) -> str:
+        '''
+            Saves the whole state of the simulation, random generators included, to a new
+            checkpoint in directory (see checkpoint.save_checkpoint). Returns its path.
+        '''
+        return save_checkpoint({"simulation": self}, directory, keep)
+
+    @classmethod
+    def resume(cls, checkpoint : str, checkpoints = None):
+        '''
+            Loads the simulation from a checkpoint file (or the newest one in a directory). If the
+            checkpoint was written by get_data, the run is finished first: the trajectory file is
+            cut back to the checkpoint and the remaining frames are appended, exactly as the
+            uninterrupted run would have written them (for compressed files the same frames,
+            but every checkpoint also ends a chunk, so the chunks can be laid out differently).
+            checkpoints keeps checkpointing that run.
+        '''
+        state = load_checkpoint(checkpoint)
+        sim = state["simulation"]
+        if (not isinstance(sim, cls)):
+            raise TypeError("checkpoint holds a " + type(sim).__name__ + ", not a " + cls.__name__)
+        if ("writer" in state):
+            sim.write_frames(state["writer"], state["steps"], state["dt"], state["frame"], checkpoints, state["options"])
+        return sim
+
 class CoarseDiffsion(Simulation):
     '''
         Simulates diffusion through the use of dicretized Ficks law
@@ -63,14 +130,14 @@ class CoarseDiffsion(Simulation):
                  ):
         super().__init__(size)
         
-        self.data = np.array([[0.0 for i in range(size[0])] for e in range(size[1])])
+        self.data = np.zeros((size[1], size[0]))
         self.diffusion_flux = np.array(diffusion_flux)
         self.diffusion_rate = diffusion_rate
         self.boundary_condition = boundary_condition
         self.total_concentration = 0
 
     def clear(self):
-        self.data = np.array([[0.0 for i in range(size[0])] for e in range(size[1])])
+        self.data = np.zeros((self.size[1], self.size[0]))
         
     def set_concentration(self, x : int, y : int, concentration : float) -> None:
         self.data[y][x] = concentration
@@ -85,14 +152,20 @@ class CoarseDiffsion(Simulation):
         self.data += (self.diffusion_rate * dt *
                       signal.convolve2d(self.data, self.diffusion_flux, mode='same', boundary=scipy_boundary, fillvalue=0))
 
-    def simulate(self, steps : int, dt : float, display = False, period = 10):
-        time_data = []
+    def simulate(self, steps : int, dt : float, display = False, period = 10,
+                 record_every = 1, capacity = None, filename = None):
+        '''
+            Runs steps steps and returns the grid before every record_every-th of them as a
+            (frames, height, width) array, see History for capacity and filename.
+        '''
+        history = History(self.data.shape, steps, record_every, capacity, filename)
         for i in range(steps):
-            time_data.append(self.data.copy())
+            if (history.due(i)):
+                history.record(self.data)
             self.step(dt)
             if (display and i % period == 0):
                 self.display()
-        return time_data
+        return history.result()
 
     def get_data(self):
         return self.data
@@ -135,19 +208,426 @@ class CoarseDiffsion(Simulation):
         s += "\n".join(d)
         return s
 
+class StencilDiffusion(CoarseDiffsion):
+    '''
+        CoarseDiffsion with a dedicated 3x3 stencil instead of signal.convolve2d.
+
+        The grid lives inside one of two preallocated buffers padded with a one cell halo, the halo
+        is refreshed in place every step (mirrored cells for reflective edges, zeros for absorbing
+        ones) and the next state is accumulated straight into the other buffer, then the two swap.
+        The explicit update data + rate * dt * (flux * data) is folded into a single stencil, which
+        is applied as two 1D passes when it is separable. Nothing is allocated per step, data is a
+        view of the current buffer.
+    '''
+    def __init__(self, size : (int, int),
+                 diffusion_flux: ((float), (float), (float)),
+                 diffusion_rate : float,
+                 boundary_condition : BoundaryCondition
+                 ):
+        super().__init__(size, diffusion_flux, diffusion_rate, boundary_condition)
+
+        height, width = size[1], size[0]
+        self.buffers = [np.zeros((height + 2, width + 2)), np.zeros((height + 2, width + 2))]
+        self.current = 0
+        self.rows = np.zeros((height + 2, width))
+        self.scratch = np.zeros((height + 2, width))
+        self.data = self.buffers[0][1:-1, 1:-1]
+        self.stencil_dt = None
+        self.factors = None
+        self.groups = {}
+
+    def clear(self):
+        for buffer in self.buffers:
+            buffer.fill(0)
+        self.data = self.buffers[self.current][1:-1, 1:-1]
+
+    def __setstate__(self, state):
+        # data has to stay a view of the current buffer, pickling made it a copy
+        self.__dict__.update(state)
+        self.data = self.buffers[self.current][1:-1, 1:-1]
+
+    def build_stencil(self, dt : float):
+        '''
+            Scales the (flipped) kernel by rate * dt. A rank one kernel is split into a column and a
+            row factor, otherwise the identity is folded in and the taps are grouped by weight so
+            that cells sharing a weight are summed before the one multiplication.
+        '''
+        stencil = self.diffusion_rate * dt * np.asarray(self.diffusion_flux, dtype=float)[::-1, ::-1]
+        self.factors = None
+        u, s, vt = np.linalg.svd(stencil)
+        if (s[0] > 0 and s[1] <= 1e-12 * s[0]):
+            self.factors = (u[:, 0] * s[0], vt[0])
+
+        stencil[1, 1] += 1
+        self.groups = {}
+        for m in range(3):
+            for n in range(3):
+                if (stencil[m, n] != 0):
+                    self.groups.setdefault(stencil[m, n], []).append((m, n))
+        self.stencil_dt = dt
+
+    def fill_halo(self, buffer):
+        if (self.boundary_condition == BoundaryCondition.REFLECTIVE):
+            buffer[0, 1:-1] = buffer[1, 1:-1]
+            buffer[-1, 1:-1] = buffer[-2, 1:-1]
+            buffer[:, 0] = buffer[:, 1]
+            buffer[:, -1] = buffer[:, -2]
+
+    def step(self, dt : float) -> None:
+        if (dt != self.stencil_dt):
+            self.build_stencil(dt)
+        height, width = self.size[1], self.size[0]
+        source = self.buffers[self.current]
+        target = self.buffers[1 - self.current][1:-1, 1:-1]
+        scratch = self.scratch[:height]
+        self.fill_halo(source)
+
+        if (self.factors is not None):
+            column, row = self.factors
+            # horizontal pass over every padded row, then the vertical pass, then the identity
+            np.multiply(source[:, 0:width], row[0], out=self.rows)
+            for n in (1, 2):
+                np.multiply(source[:, n:n + width], row[n], out=self.scratch)
+                np.add(self.rows, self.scratch, out=self.rows)
+            np.multiply(self.rows[0:height], column[0], out=target)
+            for m in (1, 2):
+                np.multiply(self.rows[m:m + height], column[m], out=scratch)
+                np.add(target, scratch, out=target)
+            np.add(target, source[1:-1, 1:-1], out=target)
+        else:
+            target.fill(0)
+            for weight, taps in self.groups.items():
+                m, n = taps[0]
+                if (len(taps) == 1):
+                    np.multiply(source[m:m + height, n:n + width], weight, out=scratch)
+                else:
+                    np.add(source[m:m + height, n:n + width], source[taps[1][0]:taps[1][0] + height, taps[1][1]:taps[1][1] + width], out=scratch)
+                    for m, n in taps[2:]:
+                        np.add(scratch, source[m:m + height, n:n + width], out=scratch)
+                    np.multiply(scratch, weight, out=scratch)
+                np.add(target, scratch, out=target)
+
+        self.current = 1 - self.current
+        self.data = target
+
+    def advance(self, n_steps : int, dt : float) -> None:
+        '''
+            Runs n_steps steps without recording anything in between.
+        '''
+        for i in range(n_steps):
+            self.step(dt)
+
+class ImplicitDiffusion(CoarseDiffsion):
+    '''
+        CoarseDiffsion integrated implicitly, stable for any diffusion_rate * dt.
+
+        The convolution with diffusion_flux under the boundary condition is written as a sparse
+        matrix L over the flattened grid. method "backward-euler" solves (I - rate * dt * L) u' = u,
+        "crank-nicolson" solves (I - rate * dt / 2 * L) u' = (I + rate * dt / 2 * L) u. The left
+        hand side is factorized once with splu and reused for as long as the grid, kernel, rate,
+        boundary condition and dt stay the same, so a step costs one sparse solve.
+        Crank-Nicolson is second order in time but can ring around sharp peaks when rate * dt is
+        very large, backward Euler is first order and always smooth.
+    '''
+    METHODS = ("backward-euler", "crank-nicolson")
+
+    def __init__(self, size : (int, int),
+                 diffusion_flux: ((float), (float), (float)),
+                 diffusion_rate : float,
+                 boundary_condition : BoundaryCondition,
+                 method = "crank-nicolson"
+                 ):
+        super().__init__(size, diffusion_flux, diffusion_rate, boundary_condition)
+        if (method not in self.METHODS):
+            raise ValueError("method must be one of " + ", ".join(self.METHODS))
+        self.method = method
+        self.factorization_key = None
+        self.factorization = None
+        self.explicit = None
+
+    def operator(self):
+        '''
+            Sparse L with L @ data.ravel() equal to the convolution in CoarseDiffsion.step, mirrored
+            cells for reflective edges ("symm") and zeros for absorbing ones ("fill").
+        '''
+        height, width = self.data.shape
+        ys, xs = np.divmod(np.arange(height * width), width)
+        kernel = np.asarray(self.diffusion_flux, dtype=float)
+        rows, cols, values = [], [], []
+        for m in range(3):
+            for n in range(3):
+                if (kernel[m, n] == 0):
+                    continue
+                ny, nx = ys + 1 - m, xs + 1 - n
+                if (self.boundary_condition == BoundaryCondition.REFLECTIVE):
+                    ny = np.where(ny < 0, -ny - 1, np.where(ny >= height, 2 * height - ny - 1, ny))
+                    nx = np.where(nx < 0, -nx - 1, np.where(nx >= width, 2 * width - nx - 1, nx))
+                    keep = np.ones(len(ny), dtype=bool)
+                else:
+                    keep = (ny >= 0) & (ny < height) & (nx >= 0) & (nx < width)
+                rows.append((ys * width + xs)[keep])
+                cols.append((ny * width + nx)[keep])
+                values.append(np.full(np.count_nonzero(keep), kernel[m, n]))
+        # duplicate entries (mirrored taps) are summed by the conversion
+        return sparse.csc_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                 shape=(height * width, height * width))
+
+    def factorize(self, dt : float):
+        key = (self.data.shape, np.asarray(self.diffusion_flux, dtype=float).tobytes(),
+               self.diffusion_rate, self.boundary_condition, self.method, dt)
+        if (key == self.factorization_key):
+            return
+        identity = sparse.identity(self.data.size, format="csc")
+        laplacian = self.diffusion_rate * dt * self.operator()
+        if (self.method == "backward-euler"):
+            self.factorization = splu((identity - laplacian).tocsc())
+            self.explicit = None
+        else:
+            self.factorization = splu((identity - laplacian / 2).tocsc())
+            self.explicit = (identity + laplacian / 2).tocsr()
+        self.factorization_key = key
+
+    def step(self, dt : float) -> None:
+        self.factorize(dt)
+        rhs = self.data.ravel()
+        if (self.explicit is not None):
+            rhs = self.explicit @ rhs
+        self.data[:] = self.factorization.solve(rhs).reshape(self.data.shape)
+
+class TiledDiffusion(CoarseDiffsion):
+    '''
+        CoarseDiffsion that only updates the parts of the grid where there is something to diffuse.
+
+        The grid is split into tile x tile blocks. A tile is active when some cell in it is above
+        threshold (in absolute value), a step updates the active tiles and the ring of tiles around
+        them, since concentration can only spread one cell per step. Every run of neighbouring
+        tiles in a row of tiles is convolved in one go on a slice of the grid with a one cell
+        margin (mirrored or zero filled at the edges of the grid), the rest of the grid is left
+        untouched. With threshold = 0 the result is exactly the dense one, a positive threshold
+        ignores tiles that only hold traces below it.
+
+        The active tiles are found again from data in refresh(), call it after writing to data
+        directly (set_concentration does it for the cell it sets).
+    '''
+    def __init__(self, size : (int, int),
+                 diffusion_flux: ((float), (float), (float)),
+                 diffusion_rate : float,
+                 boundary_condition : BoundaryCondition,
+                 tile = 32,
+                 threshold = 0
+                 ):
+        super().__init__(size, diffusion_flux, diffusion_rate, boundary_condition)
+        self.tile = tile
+        self.threshold = threshold
+        self.tiles = (-(-size[1] // tile), -(-size[0] // tile))
+        self.active = np.zeros(self.tiles, dtype=bool)
+
+    def clear(self):
+        super().clear()
+        self.active[:] = False
+
+    def set_concentration(self, x : int, y : int, concentration : float) -> None:
+        super().set_concentration(x, y, concentration)
+        self.active[y // self.tile, x // self.tile] |= abs(concentration) > self.threshold
+
+    def refresh(self):
+        '''
+            Rebuilds the active tiles from the whole grid.
+        '''
+        height, width = self.data.shape
+        rows, cols = self.tiles
+        padded = np.zeros((rows * self.tile, cols * self.tile))
+        padded[:height, :width] = np.abs(self.data)
+        tile_max = padded.reshape(rows, self.tile, cols, self.tile).max(axis=(1, 3))
+        self.active = tile_max > self.threshold
+
+    def block(self, y0 : int, y1 : int, x0 : int, x1 : int):
+        '''
+            Cells [y0 - 1, y1 + 1) x [x0 - 1, x1 + 1), padded like convolve2d pads the whole grid.
+        '''
+        height, width = self.data.shape
+        block = self.data[max(y0 - 1, 0):min(y1 + 1, height), max(x0 - 1, 0):min(x1 + 1, width)]
+        pad = ((int(y0 == 0), int(y1 == height)), (int(x0 == 0), int(x1 == width)))
+        if (self.boundary_condition == BoundaryCondition.REFLECTIVE):
+            return np.pad(block, pad, mode="symmetric")
+        return np.pad(block, pad, mode="constant")
+
+    def step(self, dt : float) -> None:
+        height, width = self.data.shape
+        rows, cols = self.tiles
+        # tiles next to an active tile can receive concentration this step
+        update = self.active.copy()
+        update[1:, :] |= self.active[:-1, :]
+        update[:-1, :] |= self.active[1:, :]
+        update[:, 1:] |= update[:, :-1].copy()
+        update[:, :-1] |= update[:, 1:].copy()
+
+        # compute every run from the old grid before writing any of them back
+        results = []
+        for r in range(rows):
+            flags = np.concatenate([[False], update[r], [False]])
+            edges = np.flatnonzero(flags[1:] != flags[:-1])
+            y0, y1 = r * self.tile, min((r + 1) * self.tile, height)
+            for start, stop in zip(edges[::2], edges[1::2]):
+                x0, x1 = start * self.tile, min(stop * self.tile, width)
+                flux = signal.convolve2d(self.block(y0, y1, x0, x1), self.diffusion_flux, mode='valid')
+                results.append((r, start, y0, y1, x0, x1, flux))
+
+        for r, start, y0, y1, x0, x1, flux in results:
+            cells = self.data[y0:y1, x0:x1]
+            cells += self.diffusion_rate * dt * flux
+            # largest value of every tile in the run
+            column_max = np.abs(cells).max(axis=0)
+            tile_max = np.maximum.reduceat(column_max, np.arange(0, x1 - x0, self.tile))
+            self.active[r, start:start + len(tile_max)] = tile_max > self.threshold
+
+class BatchedDiffusion(Simulation):
+    '''
+        A stack of CoarseDiffsion grids of the same size that are stepped together, for parameter sweeps.
+
+        diffusion_flux is either one 3x3 kernel or one per member (batch, 3, 3), diffusion_rate and
+        the dt given to step are numbers or one value per member. All members share the size and
+        boundary condition. A step pads the whole (batch, height, width) stack once and adds the
+        nine shifted slices scaled by every member's rate * dt * kernel weight (slices with the same
+        weights in every member are summed first), so the cost of a step does not grow with the
+        number of Python objects. Each member evolves like a CoarseDiffsion with its parameters,
+        up to rounding.
+
+        totals() and mass_change() give the per member amount of substance and how far it moved
+        away from what was set with set_concentration (nonzero only for absorbing boundaries).
+    '''
+    def __init__(self, size : (int, int),
+                 diffusion_flux,
+                 diffusion_rate,
+                 boundary_condition : BoundaryCondition,
+                 batch = None
+                 ):
+        super().__init__(size)
+        flux = np.asarray(diffusion_flux, dtype=float)
+        rate = np.asarray(diffusion_rate, dtype=float)
+        if (batch is None):
+            batch = max(flux.shape[0] if flux.ndim == 3 else 1, rate.size)
+        self.batch = batch
+        self.diffusion_flux = np.broadcast_to(flux, (batch, 3, 3)).copy()
+        self.diffusion_rate = np.broadcast_to(rate, (batch,)).copy()
+        self.boundary_condition = boundary_condition
+
+        height, width = size[1], size[0]
+        self.data = np.zeros((batch, height, width))
+        self.padded = np.zeros((batch, height + 2, width + 2))
+        self.scratch = np.zeros((batch, height, width))
+        self.total_concentration = np.zeros(batch)
+        self.weights_dt = None
+        self.groups = []
+
+    def clear(self):
+        self.data.fill(0)
+        self.total_concentration.fill(0)
+
+    def set_concentration(self, x : int, y : int, concentration, member = None) -> None:
+        '''
+            Sets cell (x, y) of one member, or of every member when member is None.
+            concentration can be one value per member in that case.
+        '''
+        if (member is None):
+            self.data[:, y, x] = concentration
+        else:
+            self.data[member, y, x] = concentration
+        self.total_concentration = self.totals()
+
+    def fill_halo(self):
+        self.padded[:, 1:-1, 1:-1] = self.data
+        if (self.boundary_condition == BoundaryCondition.REFLECTIVE):
+            self.padded[:, 0, 1:-1] = self.data[:, 0]
+            self.padded[:, -1, 1:-1] = self.data[:, -1]
+            self.padded[:, :, 0] = self.padded[:, :, 1]
+            self.padded[:, :, -1] = self.padded[:, :, -2]
+
+    def build_weights(self, dt):
+        '''
+            Scales every member's kernel by its rate * dt and groups the taps whose weights agree
+            for the whole batch, so that their slices are summed before the one multiplication.
+        '''
+        scale = self.diffusion_rate * np.broadcast_to(np.asarray(dt, dtype=float), (self.batch,))
+        weights = scale[:, None, None] * self.diffusion_flux
+        self.groups = []
+        for m in range(3):
+            for n in range(3):
+                weight = weights[:, m, n]
+                if (not np.any(weight)):
+                    continue
+                for taps_weight, taps in self.groups:
+                    if (np.array_equal(taps_weight, weight)):
+                        taps.append((m, n))
+                        break
+                else:
+                    self.groups.append((weight, [(m, n)]))
+        self.weights_dt = np.array(dt, dtype=float)
+
+    def step(self, dt) -> None:
+        if (self.weights_dt is None or not np.array_equal(self.weights_dt, dt)):
+            self.build_weights(dt)
+        height, width = self.size[1], self.size[0]
+        self.fill_halo()
+        for weight, taps in self.groups:
+            # convolution, kernel tap (m, n) reads the neighbour at (1 - m, 1 - n)
+            m, n = taps[0]
+            np.copyto(self.scratch, self.padded[:, 2 - m:2 - m + height, 2 - n:2 - n + width])
+            for m, n in taps[1:]:
+                np.add(self.scratch, self.padded[:, 2 - m:2 - m + height, 2 - n:2 - n + width], out=self.scratch)
+            np.multiply(self.scratch, weight[:, None, None], out=self.scratch)
+            np.add(self.data, self.scratch, out=self.data)
+
+    def simulate(self, steps : int, dt, display = False, period = 10,
+                 record_every = 1, capacity = None, filename = None):
+        history = History(self.data.shape, steps, record_every, capacity, filename)
+        for i in range(steps):
+            if (history.due(i)):
+                history.record(self.data)
+            self.step(dt)
+        return history.result()
+
+    def get_data(self):
+        return self.data
+
+    def totals(self):
+        '''
+            Amount of substance in every member.
+        '''
+        return self.data.sum(axis=(1, 2))
+
+    def mass_change(self):
+        '''
+            Amount of substance gained (negative for lost) by every member since it was set.
+        '''
+        return self.totals() - self.total_concentration
+
+    def member(self, b : int) -> CoarseDiffsion:
+        '''
+            Member b as a standalone CoarseDiffsion with a copy of its grid.
+        '''
+        sim = CoarseDiffsion(self.size, self.diffusion_flux[b], self.diffusion_rate[b], self.boundary_condition)
+        sim.data = self.data[b].copy()
+        sim.total_concentration = self.total_concentration[b]
+        return sim
+
 class BrownianMotion(Simulation):
     '''
         Simulated diffusion through Brownian Motion.
 
         This simulation will use the wierner process to approximate diffusion.
-        
+        The increments come from a private random.Random seeded with seed, an int or a
+        numpy.random.Generator (which then draws the seed).
     '''
-    def __init__(self, size : (float, float), diffusion_rate : float, boundary_condition : BoundaryCondition):
+    def __init__(self, size : (float, float), diffusion_rate : float, boundary_condition : BoundaryCondition, seed = None):
         super().__init__(size)
 
         self.simdata = SimMap(size)
         self.diffusion_rate =  diffusion_rate
         self.boundary_condition = boundary_condition
+        if (isinstance(seed, np.random.Generator)):
+            seed = int(seed.integers(2**63))
+        self.random = random.Random(seed)
 
     def copy(self):
         sim = BrownianMotion(self.size, self.diffusion_rate, self.boundary_condition)
@@ -161,8 +641,8 @@ class BrownianMotion(Simulation):
         keys = self.simdata.get_ids()
         for i in keys:
             point = self.simdata.get_particle(i)
-            dx = random.gauss(0, 2 * self.diffusion_rate * dt)
-            dy = random.gauss(0, 2 * self.diffusion_rate * dt)
+            dx = self.random.gauss(0, 2 * self.diffusion_rate * dt)
+            dy = self.random.gauss(0, 2 * self.diffusion_rate * dt)
             newx = point[0] + dx
             newy = point[1] + dy
 
@@ -179,14 +659,20 @@ class BrownianMotion(Simulation):
 
             self.simdata.update_particle(i, newx, newy)
 
-    def simulate(self, steps : int, dt : float, display = False, period = 10):
-        time_data = []
+    def simulate(self, steps : int, dt : float, display = False, period = 10,
+                 record_every = 1, capacity = None, filename = None):
+        '''
+            Runs steps steps and returns the positions before every record_every-th of them as a
+            (frames, N, 2) array, columns ordered like get_ids(). See History for capacity and filename.
+        '''
+        history = History((len(self.simdata.get_ids()), 2), steps, record_every, capacity, filename)
         for i in range(steps):
-            time_data.append(self.simdata.copy())
+            if (history.due(i)):
+                history.record(self.simdata.get_positions())
             self.step(dt)
             if (display and i % period == 0):
                 self.display()
-        return time_data
+        return history.result()
     
     def animate(self, steps : int, dt : float):
         fig = plt.figure()
@@ -214,23 +700,14 @@ class BrownianMotion(Simulation):
         anim.save("test.gif")
         plt.show() 
 
-    def get_data(self, filename : str, steps : int, dt : float):
-        with open(filename, "w") as f:
-            time_data = []
-            for i in range(steps):
-                time_data.append(self.simdata.copy())
-                self.step(dt)
-            time_data.append(self.simdata.copy())
-
-            f.write(str(self.size[0]) + " " + str(self.size[1]) + "\n")
-            f.write(str(steps) + " " + str(dt) + "\n")
-            f.write(str(len(self.simdata.get_ids())) + "\n")
-
-            for id in self.simdata.get_ids():
-                for t in time_data:
-                    pos = t.get_particle(id)
-                    f.write("(" + str(pos[0]) + "," + str(pos[1]) + ") ")
-                f.write("\n")
+    def get_data(self, filename : str, steps : int, dt : float, layout = "particle", checkpoints = None,
+                 error = None):
+        '''
+            Runs steps steps and streams the steps + 1 frames to filename, see TrajectoryWriter for
+            layout and error (how far compressed positions may be off) and write_frames for checkpoints.
+        '''
+        writer = TrajectoryWriter(filename, self.size, steps, dt, len(self.simdata.get_ids()), layout, error=error)
+        self.write_frames(writer, steps, dt, 0, checkpoints)
 
     def display(self):
         plt.clf()
@@ -248,151 +725,482 @@ class BrownianMotion(Simulation):
         s += str(self.simdata.get_data())
         return s
 
-def normalize(vec):
-    mag = 0
-    for i in vec:
-        mag += i ** 2
-    return vec / mag ** .5
+def reflect(positions, size):
+    '''
+        Folds positions back into the box [0, size] in place, as if they had bounced off the walls.
+        The fold is exact for displacements of any length (several reflections in one move).
+    '''
+    size = np.asarray(size, dtype=float)
+    np.mod(positions, 2 * size, out=positions)
+    np.subtract(2 * size, positions, out=positions, where=positions > size)
+    return positions
+
+class ArrayBrownianMotion(BrownianMotion):
+    '''
+        Array backed version of BrownianMotion.
+
+        Positions live in an (N, 2) array (SimArray) and every step draws all of the wierner
+        increments with one call to numpy.random.Generator.normal. Reflective boundaries are applied
+        as a vectorized fold. Each increment has standard deviation sqrt(2 * D * dt).
+        time is the simulated time so far.
+
+        With absorbing boundaries particles that leave the box are removed from the simulation and
+        their exit time, wall and position are recorded (see first_passage_times and survival).
+        Besides the particles that end a step outside, a particle that ends it inside is absorbed
+        with the probability that its path touched a wall during the step (brownian bridge), which
+        is exact for steps up to bridge_step().
+        Absorbed particles stay at their exit position in the output of simulate and get_data.
+    '''
+    def __init__(self, size : (float, float), diffusion_rate : float, boundary_condition : BoundaryCondition, seed = None):
+        super().__init__(size, diffusion_rate, boundary_condition)
 
-class ParticleDynamics(Simulation):
+        self.simdata = SimArray(size)
+        self.rng = np.random.default_rng(seed)
+        self.time = 0.0
+        # one (ids, times, walls, positions) tuple per step in which particles were absorbed
+        self.exits = []
+
+    def copy(self):
+        sim = ArrayBrownianMotion(self.size, self.diffusion_rate, self.boundary_condition)
+        sim.simdata = self.simdata.copy()
+        sim.rng.bit_generator.state = self.rng.bit_generator.state
+        sim.time = self.time
+        sim.exits = list(self.exits)
+        return sim
+
+    def add_particles(self, positions):
+        return self.simdata.add_particles(positions)
 
-    def __init__(self, size : (float, float), boundary_condition : BoundaryCondition):
+    def step(self, dt : float):
+        n = self.simdata.count
+        if (n == 0 or n == self.simdata.dead):
+            self.time += dt
+            return
+        positions = self.simdata.positions[:n]
+        steps = self.rng.normal(0, math.sqrt(2 * self.diffusion_rate * dt), size=(n, 2))
+
+        if (self.boundary_condition == BoundaryCondition.REFLECTIVE):
+            positions += steps
+            # only the few particles that crossed a wall need to be folded back
+            outside = np.flatnonzero(~self.simdata.in_bounds(positions))
+            if (len(outside) > 0):
+                positions[outside] = reflect(positions[outside], self.size)
+        else:
+            self.absorb(positions, positions + steps, dt)
+        self.time += dt
+
+    def absorb(self, positions, moved, dt : float):
+        '''
+            Moves the living particles to moved and removes the ones that were absorbed on the way.
+        '''
+        alive = self.simdata.alive[:len(positions)]
+        width, height = self.size
+        # a path between points a and b away from a wall touched it with probability
+        # exp(-a * b / (D * dt)), which is negligible unless one of them is close to the wall
+        reach = math.sqrt(40 * self.diffusion_rate * dt)
+        edge_x = np.minimum(np.minimum(positions[:, 0], moved[:, 0]), width - np.maximum(positions[:, 0], moved[:, 0]))
+        edge_y = np.minimum(np.minimum(positions[:, 1], moved[:, 1]), height - np.maximum(positions[:, 1], moved[:, 1]))
+        near = np.flatnonzero(alive & (np.minimum(edge_x, edge_y) < reach))
+
+        # distance to the left, right, bottom and top walls before and after the step
+        start, end = positions[near], moved[near]
+        before = np.stack([start[:, 0], width - start[:, 0], start[:, 1], height - start[:, 1]], axis=1)
+        after = np.stack([end[:, 0], width - end[:, 0], end[:, 1], height - end[:, 1]], axis=1)
+        np.copyto(positions, moved, where=alive[:, None])
+        if (len(near) == 0):
+            return
+
+        outside = np.any(after <= 0, axis=1)
+        wall = np.argmin(after, axis=1)
+        touched = np.exp(-np.maximum(before, 0) * np.maximum(after, 0) / (self.diffusion_rate * dt))
+        crossed = ~outside & (self.rng.random(len(near)) < 1 - np.prod(1 - touched, axis=1))
+        wall[crossed] = np.argmax(touched[crossed], axis=1)
+        absorbed = outside | crossed
+
+        rows = near[absorbed]
+        if (len(rows) == 0):
+            return
+        walls = wall[absorbed]
+        exit = np.clip(positions[rows], 0, self.size)
+        exit[walls == Wall.LEFT.value, 0] = 0
+        exit[walls == Wall.RIGHT.value, 0] = width
+        exit[walls == Wall.BOTTOM.value, 1] = 0
+        exit[walls == Wall.TOP.value, 1] = height
+        positions[rows] = exit
+
+        self.exits.append((self.simdata.ids[rows].copy(), np.full(len(rows), self.time + dt), walls, exit))
+        self.simdata.remove_particles(rows)
+
+    def first_passage_times(self):
+        '''
+            Returns the ids, exit times and walls (Wall values) of every absorbed particle in order of absorption.
+        '''
+        if (len(self.exits) == 0):
+            return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64)
+        return tuple(np.concatenate([exit[k] for exit in self.exits]) for k in range(3))
+
+    def survival(self, times):
+        '''
+            Fraction of all particles (living and absorbed) that are still in the box at each of times.
+        '''
+        ids, exit_times, walls = self.first_passage_times()
+        total = len(self.simdata.get_ids()) + len(ids)
+        if (total == 0):
+            return np.ones(len(np.atleast_1d(times)))
+        exit_times = np.sort(exit_times)
+        return 1 - np.searchsorted(exit_times, np.atleast_1d(times), side="right") / total
+
+    def record(self, snapshot, previous, ids, exits : int):
+        '''
+            Writes the positions of the particles in ids into the (len(ids), 2) snapshot. Particles
+            absorbed since the previous snapshot are put at their exit position, older ones keep
+            their place in previous. exits is how many entries of self.exits existed at previous.
+        '''
+        current = self.simdata.get_ids()
+        if (len(current) == len(ids)):
+            snapshot[:] = self.simdata.get_data()
+            return
+        snapshot[:] = previous
+        snapshot[np.searchsorted(ids, current)] = self.simdata.get_data()
+        for exit_ids, exit_times, walls, positions in self.exits[exits:]:
+            columns = np.minimum(np.searchsorted(ids, exit_ids), len(ids) - 1)
+            known = ids[columns] == exit_ids
+            snapshot[columns[known]] = positions[known]
+
+    def bridge_step(self) -> float:
+        '''
+            Longest step for which the reach of absorb (sqrt(40 * D * dt)) is at most half the
+            narrower side of the box, so no particle is near both walls of an axis. The x and y
+            motions are independent, so the crossing probability of each axis is then exact.
+        '''
+        return min(self.size) ** 2 / (160 * self.diffusion_rate)
+
+    def jump(self, time : float):
+        '''
+            Advances to time, in a single draw with reflective boundaries and in as few equal steps
+            of at most bridge_step() as possible with absorbing ones.
+        '''
+        if (self.boundary_condition == BoundaryCondition.REFLECTIVE):
+            self.step(time - self.time)
+            self.time = time
+            return
+        start = self.time
+        substeps = max(1, math.ceil((time - start) / self.bridge_step()))
+        for k in range(1, substeps + 1):
+            end = time if k == substeps else start + (time - start) * k / substeps
+            exits = len(self.exits)
+            self.step(end - self.time)
+            self.time = end
+            # stamp the exits with the end of the step exactly, so survival(time) counts them
+            for exit in self.exits[exits:]:
+                exit[1][:] = end
+
+    def sample_at(self, times):
+        '''
+            Jumps straight to each of the non-decreasing times and returns the positions there as a
+            (len(times), N, 2) array, without any of the intermediate steps.
+
+            A wierner increment over an interval of any length is gaussian with variance
+            2 * D * interval, and folding the free displacement back into the box is exactly how a
+            reflected path ends up, so one draw per output time gives the same distribution as
+            stepping there. The brownian bridge test of absorbing walls only holds while a particle
+            can reach one wall of each axis per step, so with absorbing boundaries every jump is
+            split into steps of at most bridge_step() (see jump) and the exit times are those steps.
+        '''
+        times = np.asarray(times, dtype=float).reshape(-1)
+        if (np.any(np.diff(times) < 0) or (len(times) > 0 and times[0] < self.time)):
+            raise ValueError("times must be non-decreasing and not before the current time")
+
+        ids = self.simdata.get_ids().copy()
+        previous = self.simdata.get_data().copy()
+        samples = np.empty((len(times), len(ids), 2))
+        exits = len(self.exits)
+        for k, t in enumerate(times.tolist()):
+            if (t > self.time):
+                self.jump(t)
+            self.record(samples[k], previous, ids, exits)
+            previous = samples[k]
+            exits = len(self.exits)
+        return samples
+
+    def simulate(self, steps : int, dt : float, display = False, period = 10,
+                 record_every = 1, capacity = None, filename = None):
+        ids = self.simdata.get_ids().copy()
+        history = History((len(ids), 2), steps, record_every, capacity, filename)
+        previous = self.simdata.get_data().copy()
+        exits = len(self.exits)
+        for i in range(steps):
+            if (history.due(i)):
+                frame = history.next_frame()
+                self.record(frame, previous, ids, exits)
+                previous = frame
+                exits = len(self.exits)
+            self.step(dt)
+            if (display and i % period == 0):
+                self.display()
+        return history.result()
+
+    def write_frame(self, writer):
+        ids, previous, exits = self.recording
+        frame = writer.next_frame()
+        self.record(frame, previous, ids, exits)
+        self.recording = (ids, frame.copy(), len(self.exits))
+
+    def get_data(self, filename : str, steps : int, dt : float, layout = "particle", checkpoints = None,
+                 error = None):
+        # ids, previous frame and exits of the trajectory being written, kept on the simulation
+        # so that they are part of its checkpoints
+        ids = self.simdata.get_ids().copy()
+        self.recording = (ids, self.simdata.get_data().copy(), len(self.exits))
+        writer = TrajectoryWriter(filename, self.size, steps, dt, len(ids), layout, error=error)
+        self.write_frames(writer, steps, dt, 0, checkpoints)
+
+def collide(positions, velocities, radii, size : (float, float), dt : float,
+            boundary_condition : BoundaryCondition, broad_phase : BroadPhase):
+    '''
+        Resolves the wall and particle-particle collisions of one ParticleDynamics step in place.
+        positions are the projected positions at the end of the step.
+    '''
+    #boundary collisions O(n)
+    if (boundary_condition == BoundaryCondition.REFLECTIVE):
+        low = positions <= radii[:, None]
+        high = ~low & (positions >= np.asarray(size) - radii[:, None])
+        positions[low] = np.broadcast_to(radii[:, None], positions.shape)[low]
+        positions[high] = (np.asarray(size) - radii[:, None])[high]
+        velocities[low | high] *= -1
+
+    ##### particle-particle collisions ##########
+    # candidate pairs come back as rows of the projected positions
+    rows_a, rows_b = broad_phase.candidate_pairs(positions, radii)
+    resolve_collisions(positions, velocities, radii, rows_a, rows_b, dt)
+
+class HybridDiffusion(Simulation):
+    '''
+        Couples ArrayBrownianMotion inside a region of interest with CoarseDiffsion everywhere else.
+
+        region = (x0, y0, x1, y1) is a block of grid cells (one cell is one unit of length).
+        Inside it the substance is carried by particles that each hold quantum of it, outside it
+        lives on the grid, and the grid of the region keeps the remainder (less than a quantum
+        per cell). Every step the grid outside is stepped on the whole concentration (particles
+        counted in their cells) and the mass it exchanges with the region is worked out across
+        the interface faces with the same kernel, so a uniform state stays uniform. Particles
+        move inside the region and are reflected at its border, they only cross it as that
+        exchange: a region cell that gained whole quanta spawns particles placed uniformly in it,
+        one that lost mass gives up particles from the cell. particles * quantum + grid total is
+        conserved to rounding with reflective boundaries.
+
+        The particles diffuse with the coefficient implied by the kernel,
+        D = diffusion_rate * sum(flux * |offset| ** 2) / 4, which matches the grid for symmetric kernels.
+        Placing spawned particles anywhere in their cell adds a little spreading at the interface,
+        of the order of the cell size, so keep the region away from where accuracy matters most.
+    '''
+    def __init__(self, size : (int, int),
+                 diffusion_flux: ((float), (float), (float)),
+                 diffusion_rate : float,
+                 boundary_condition : BoundaryCondition,
+                 region : (int, int, int, int),
+                 quantum : float,
+                 seed = None
+                 ):
         super().__init__(size)
+        self.grid = CoarseDiffsion(size, diffusion_flux, diffusion_rate, boundary_condition)
+        offsets = np.array([[(m - 1) ** 2 + (n - 1) ** 2 for n in range(3)] for m in range(3)])
+        particle_rate = diffusion_rate * np.sum(self.grid.diffusion_flux * offsets) / 4
+        self.particles = ArrayBrownianMotion(size, particle_rate, boundary_condition, seed)
+        self.boundary_condition = boundary_condition
+        self.region = region
+        self.quantum = quantum
 
-        self.simdata = ParticleMap(size)
+        x0, y0, x1, y1 = region
+        self.inside = np.zeros((size[1], size[0]), dtype=bool)
+        self.inside[y0:y1, x0:x1] = True
+
+    def in_region(self, positions):
+        x0, y0, x1, y1 = self.region
+        return ((positions[:, 0] >= x0) & (positions[:, 0] < x1) &
+                (positions[:, 1] >= y0) & (positions[:, 1] < y1))
+
+    def set_concentration(self, x : int, y : int, concentration : float) -> None:
+        '''
+            Sets the amount of substance in cell (x, y), inside the region it is turned into particles.
+        '''
+        self.grid.data[y][x] = concentration
+        self.spawn()
+
+    def add_particles(self, positions):
+        '''
+            Adds particles of quantum each, the ones outside the region go straight to the grid.
+        '''
+        ids = self.particles.add_particles(positions)
+        self.deposit()
+        return ids
+
+    def deposit(self):
+        '''
+            Moves the particles that are outside the region onto the grid.
+        '''
+        n = self.particles.simdata.count
+        positions = self.particles.simdata.positions[:n]
+        rows = np.flatnonzero(self.particles.simdata.alive[:n] & ~self.in_region(positions))
+        if (len(rows) == 0):
+            return
+        cells = np.floor(positions[rows]).astype(np.int64)
+        cells[:, 0] = np.clip(cells[:, 0], 0, self.size[0] - 1)
+        cells[:, 1] = np.clip(cells[:, 1], 0, self.size[1] - 1)
+        np.add.at(self.grid.data, (cells[:, 1], cells[:, 0]), self.quantum)
+        self.particles.simdata.remove_particles(rows)
+
+    def spawn(self):
+        '''
+            Turns every whole quantum of grid mass inside the region into a particle.
+        '''
+        ys, xs = np.nonzero(self.inside & (self.grid.data >= self.quantum))
+        if (len(ys) == 0):
+            return
+        counts = np.floor(self.grid.data[ys, xs] / self.quantum).astype(np.int64)
+        self.grid.data[ys, xs] -= counts * self.quantum
+        cells = np.repeat(np.stack([xs, ys], axis=1), counts, axis=0)
+        # strictly inside the cell, SimArray drops positions on the walls of the box
+        offsets = np.clip(self.particles.rng.random((len(cells), 2)), 1e-9, 1 - 1e-9)
+        self.particles.add_particles(cells + offsets)
+
+    def release(self):
+        '''
+            Removes particles from the region cells whose grid remainder went negative, a quantum
+            each until the remainder is back at zero or above (or the cell has no particles left).
+        '''
+        ys, xs = np.nonzero(self.inside & (self.grid.data < 0))
+        if (len(ys) == 0):
+            return
+        need = np.zeros(self.grid.data.size, dtype=np.int64)
+        need[ys * self.size[0] + xs] = np.ceil(-self.grid.data[ys, xs] / self.quantum)
+
+        n = self.particles.simdata.count
+        rows = np.flatnonzero(self.particles.simdata.alive[:n])
+        cells = np.floor(self.particles.simdata.positions[rows]).astype(np.int64)
+        flat = cells[:, 1] * self.size[0] + cells[:, 0]
+        rows, flat = rows[need[flat] > 0], flat[need[flat] > 0]
+        order = np.argsort(flat, kind="stable")
+        rows, flat = rows[order], flat[order]
+        # the first need[cell] particles of every cell go
+        rank = np.arange(len(flat)) - np.searchsorted(flat, flat)
+        taken = rank < need[flat]
+        np.add.at(self.grid.data.reshape(-1), flat[taken], self.quantum)
+        self.particles.simdata.remove_particles(rows[taken])
+
+    def step(self, dt : float) -> None:
+        boundary = "fill" if self.boundary_condition == BoundaryCondition.ABSORBTION else "symm"
+        def convolve(a):
+            return signal.convolve2d(a, self.grid.diffusion_flux, mode='same', boundary=boundary, fillvalue=0)
+        full = self.concentration()
+        outside = ~self.inside
+        # outside the grid steps as usual on the whole concentration, each region cell exchanges
+        # sum K * (c_outside - c_cell) with its outside neighbours, the same pairwise fluxes seen from the other side
+        change = self.grid.diffusion_rate * dt * np.where(
+            outside, convolve(full), convolve(full * outside) - full * convolve(outside.astype(float)))
+        self.grid.data += change
+
+        self.particles.step(dt)
+        n = self.particles.simdata.count
+        positions = self.particles.simdata.positions[:n]
+        escaped = np.flatnonzero(self.particles.simdata.alive[:n] & ~self.in_region(positions))
+        if (len(escaped) > 0):
+            x0, y0, x1, y1 = self.region
+            origin = np.array([x0, y0], dtype=float)
+            folded = reflect(positions[escaped] - origin, (x1 - x0, y1 - y0)) + origin
+            # strictly inside, a fold can land on the far border of the region
+            positions[escaped] = np.minimum(folded, np.array([x1, y1]) - 1e-9)
+        self.spawn()
+        self.release()
+
+    def concentration(self):
+        '''
+            Grid of the whole system, particles are counted as quantum in the cell they are in.
+        '''
+        positions = self.particles.simdata.get_data()
+        cells = np.floor(positions).astype(np.int64)
+        counts = np.bincount(cells[:, 1] * self.size[0] + cells[:, 0], minlength=self.size[0] * self.size[1])
+        return self.grid.data + self.quantum * counts.reshape(self.size[1], self.size[0])
+
+    def total_mass(self) -> float:
+        return np.sum(self.grid.data) + self.quantum * len(self.particles.simdata.get_ids())
+
+    def simulate(self, steps : int, dt : float, display = False, period = 10,
+                 record_every = 1, capacity = None, filename = None):
+        history = History(self.grid.data.shape, steps, record_every, capacity, filename)
+        for i in range(steps):
+            if (history.due(i)):
+                history.record(self.concentration())
+            self.step(dt)
+        return history.result()
+
+    def get_data(self):
+        return self.concentration()
+
+class ParticleDynamics(Simulation):
+    '''
+        Step-based simulation of elastic collisions between hard disks.
+
+        compact = True keeps the particles in a struct-of-arrays ParticleArray instead of a
+        ParticleMap of Particle objects.
+        broad_phase picks the candidate pairs for the collision checks (see broadphase.py),
+        it defaults to a cell list sized from the largest radius.
+        simulate and get_data can run adaptively, every requested dt is then split into substeps
+        sized from the fastest particle (see advance_adaptive), substeps records how many each dt took.
+    '''
+    def __init__(self, size : (float, float), boundary_condition : BoundaryCondition, compact = False,
+                 broad_phase : BroadPhase = None):
+        super().__init__(size)
+
+        self.simdata = ParticleArray(size) if compact else ParticleMap(size)
         self.boundary_condition = boundary_condition
+        self.broad_phase = broad_phase if broad_phase is not None else CellListBroadPhase()
+        self.substeps = []
 
     def add_particle(self, radius : float, position : [float], velocity : [float]):
         return self.simdata.add_particle(radius, position, velocity, [0,0])
 
-    def get_data(self, filename : str, steps : int, dt : float):
-        with open(filename, "w") as f:
-            time_data = []
-            for i in range(steps):
-                time_data.append(self.simdata.copy())
-                self.step(dt)
-            time_data.append(self.simdata.copy())
-
-            f.write(str(self.size[0]) + " " + str(self.size[1]) + "\n")
-            f.write(str(steps) + " " + str(dt) + "\n")
-            f.write(str(len(self.simdata.get_ids())) + "\n")
-
-            for id in self.simdata.get_ids():
-                for t in time_data:
-                    pos = t.get_particle(id).position
-                    f.write("(" + str(pos[0]) + "," + str(pos[1]) + ") ")
-                f.write("\n")
+    def place_particles(self, n : int, radius, velocity = (0, 0), region = None, inside = None, seed = None):
+        '''
+            Places up to n particles that overlap neither each other nor the particles already in the simulation.
+
+            radius is a number or a function (rng, count) -> radii and velocity is a fixed (vx, vy) or
+            a function (rng, count) -> (count, 2) velocities. region = (xmin, ymin, xmax, ymax)
+            defaults to the whole box, inside is an optional function (positions) -> boolean mask
+            for other shapes. seed is anything numpy.random.default_rng accepts.
+            Returns how many particles were placed, which is less than n when the density
+            cannot be reached.
+        '''
+        rng = np.random.default_rng(seed)
+        if (region is None):
+            region = (0, 0, self.size[0], self.size[1])
+        positions, radii = place_disks(rng, n, radius, region, inside,
+                                       self.simdata.project(0), self.simdata.get_radii())
+        velocities = velocity(rng, len(positions)) if callable(velocity) else velocity
+        self.simdata.add_particles(radii, positions, velocities)
+        return len(positions)
+
+    def get_data(self, filename : str, steps : int, dt : float, adaptive = False, cfl = .5, layout = "particle",
+                 checkpoints = None, error = None):
+        writer = TrajectoryWriter(filename, self.size, steps, dt, len(self.simdata.get_ids()), layout, error=error)
+        self.write_frames(writer, steps, dt, 0, checkpoints, {"adaptive": adaptive, "cfl": cfl})
+
+    def advance_frame(self, dt : float, adaptive = False, cfl = .5):
+        if (adaptive):
+            self.substeps.append(self.advance_adaptive(dt, cfl))
+        else:
+            self.step(dt)
 
     def step(self, dt : float):
         # get projected positions O(n)
-        new_positions = {}
-        for id in self.simdata.get_ids():
-            particle = self.simdata.get_particle(id)
-            new_pos = [0 for i in range(particle.dimensions)]
-            for p in range(particle.dimensions):
-                new_pos[p] = particle.velocity[p] * dt + 1/2 * particle.acc[p] * dt ** 2 + particle.position[p]
-            new_positions[id] = new_pos
-
-        #boundary collisions O(n)
-        new_velocities = {}
-        if (self.boundary_condition == BoundaryCondition.REFLECTIVE):
-            for id in self.simdata.get_ids():
-                position = new_positions[id]
-                if (not self.simdata.in_bounds(position, self.simdata.get_particle(id).radius)):
-                    if (not id in new_velocities):
-                        new_velocities[id] = self.simdata.get_particle(id).velocity
-                    for p in range(len(position)):
-                        radius = self.simdata.get_particle(id).radius
-                        if (position[p] <= radius):
-                            position[p] -= (position[p] - radius)
-                            new_velocities[id][p] = -1 * new_velocities[id][p]
-                        elif(position[p] >= self.size[p] - radius):
-                            position[p] -= (position[p] + radius - self.size[p])
-                            new_velocities[id][p] = -1 * new_velocities[id][p]
-        ##### particle-particle collisions O(nlogn) ##########
-
-        pos_to_id = {}
-        # for id in self.simdata.get_ids():
-        #     pos = self.simdata.get_particle(id).position
-        #     pos_to_id[tuple(pos)] = id
-        for id in self.simdata.get_ids():
-            pos = new_positions[id]
-            pos_to_id[tuple(pos)] = id
-
-        # get all edges in the Delaunay graph
-        points_to_check = set()
-        # points = [i.position for i in self.simdata.get_data()]
-        points = [i for i in new_positions.values()]
-        points = np.array(points)
-        del_graph = Delaunay(points)
-        for triangle in del_graph.simplices:
-            ps = np.sort(triangle)
-            points_to_check.add((ps[0], ps[1]))
-            points_to_check.add((ps[0], ps[2]))
-            points_to_check.add((ps[1], ps[2]))
-        
-        # go from indices to ids
-        id_pairs = set()
-        for pair in points_to_check:
-            id_pairs.add((pos_to_id[tuple(del_graph.points[pair[0]])], pos_to_id[tuple(del_graph.points[pair[1]])])) 
-
-        # check collisions between id pairs
-        epsilon = dt / 100
-        collided = set()
-        for id_pair in id_pairs:
-            a = self.simdata.get_particle(id_pair[0]).copy()
-            b = self.simdata.get_particle(id_pair[1]).copy()
-
-            a.position = new_positions[id_pair[0]]
-            b.position = new_positions[id_pair[1]]
-
-            # the particles have collided resolve the collision
-            if (pdist([a.position, b.position]) < a.radius + b.radius and (a.moving() or b.moving)):
-                normal = np.array(b.position) - np.array(a.position)
-                unit_norm = normalize(normal)
-
-                van = np.dot(unit_norm, a.velocity) 
-                vbn = np.dot(unit_norm, b.velocity)
-
-                # resolve the positions 
-                diff = a.radius + b.radius - pdist([a.position, b.position])
-                t_intercept = diff / (np.abs(van) + np.abs(vbn))
-                # print("start:", pdist([a.position, b.position]), id_pair, "positions:", a.position, b.position)
-                # print("Intercept:", t_intercept, "diff:", diff, "van:", van, "vbn:", vbn)
-                # print("velocity:", a.velocity, b.velocity)
-
-                # exact positions when they collided
-                a_prev = np.array(a.position) + np.array(a.velocity) * t_intercept * -1
-                b_prev = np.array(b.position) + np.array(b.velocity) * t_intercept * -1
-                # print(pdist([a_prev, b_prev]), a.radius + b.radius)
-
-                # calculate the velocity after the collision
-                normal = np.array(b_prev) - np.array(a_prev)
-                unit_norm = normalize(normal)
-                tangent = np.array([-1 * unit_norm[1], unit_norm[0]])
-
-                van = np.dot(unit_norm, a.velocity)
-                vat = np.dot(tangent, a.velocity)
-
-                vbn = np.dot(unit_norm, b.velocity)
-                vbt = np.dot(tangent, b.velocity)
-
-                #elastic collisions equal mass
-                new_velocities[id_pair[0]] = vat * tangent + vbn * unit_norm
-                new_velocities[id_pair[1]] = vbt * tangent + van * unit_norm
-                # print("new_velocities:", new_velocities[id_pair[0]], new_velocities[id_pair[1]])
-                
-                # alter the positions 
-                # new_positions[id_pair[0]] = a_prev + new_velocities[id_pair[0]] * (t_intercept + dt)
-                # new_positions[id_pair[1]] = b_prev + new_velocities[id_pair[1]] * (t_intercept + dt)
-                new_positions[id_pair[0]] = a_prev + new_velocities[id_pair[0]] * (t_intercept)
-                new_positions[id_pair[1]] = b_prev + new_velocities[id_pair[1]] * (t_intercept)
+        positions = self.simdata.project(dt)
+        velocities = self.simdata.get_velocities()
+        radii = self.simdata.get_radii()
+
+        collide(positions, velocities, radii, self.size, dt, self.boundary_condition, self.broad_phase)
 
         #update all positions and velocities O(n)
-        for id in self.simdata.get_ids():
-            self.simdata.update_particle_pos(id, new_positions[id])
-        for id in new_velocities.keys():
-            self.simdata.update_particle_velocity(id, new_velocities[id])
+        self.simdata.update_particles(positions, velocities)
 
         # https://www.vobarian.com/collisions/2dcollisions2.pdf
 
@@ -445,7 +1253,248 @@ class ParticleDynamics(Simulation):
         # plt.scatter(x,y)
         plt.show()
 
-    def simulate(self, steps : int, dt : float):
+    def substep_size(self, dt : float, cfl = .5):
+        '''
+            CFL-style bound: the largest step up to dt in which no particle moves further than cfl
+            times the smallest radius (or the broad phase cell size if that is smaller).
+        '''
+        radii = self.simdata.get_radii()
+        if (len(radii) == 0):
+            return dt
+        length = np.min(radii)
+        if (isinstance(self.broad_phase, CellListBroadPhase)):
+            length = min(length, self.broad_phase.cutoff(radii))
+        # distance travelled over dt, this includes the acceleration term
+        travel = np.max(np.sqrt(np.sum((self.simdata.project(dt) - self.simdata.project(0)) ** 2, axis=1)))
+        if (travel * cfl == 0 or travel <= cfl * length):
+            return dt
+        return dt * cfl * length / travel
+
+    def advance_adaptive(self, dt : float, cfl = .5):
+        '''
+            Advances the simulation by exactly dt in adaptive substeps, returns the number of substeps.
+            With cfl <= .5 two particles close in on each other by at most the smallest radius per
+            substep, so collisions cannot be skipped.
+        '''
+        remaining = dt
+        substeps = 0
+        while (remaining > 0):
+            h = self.substep_size(remaining, cfl)
+            # do not leave a sliver of the interval for an extra substep
+            if (remaining - h <= 1e-9 * dt):
+                h = remaining
+            self.step(h)
+            remaining -= h
+            substeps += 1
+        return substeps
+
+    def simulate(self, steps : int, dt : float, adaptive = False, cfl = .5,
+                 record_every = None, capacity = None, filename = None):
+        '''
+            Runs steps steps. Nothing is recorded by default (record_every = None) and None is
+            returned. With record_every the positions before every record_every-th step are
+            returned as a (frames, N, 2) array, columns ordered like get_ids(). See History for
+            capacity and filename.
+        '''
+        history = None
+        if (record_every is not None):
+            history = History((len(self.simdata.get_ids()), 2), steps, record_every, capacity, filename)
         for t in range(steps):
-            self.step(dt)
+            if (history is not None and history.due(t)):
+                history.record(self.simdata.get_positions())
+            if (adaptive):
+                self.substeps.append(self.advance_adaptive(dt, cfl))
+            else:
+                self.step(dt)
+        return history.result() if history is not None else None
+
+
+class EventDrivenDynamics(ParticleDynamics):
+    '''
+        Event-driven (time of collision) simulation of elastic collisions between hard disks.
+
+        Instead of moving every particle by a fixed dt the simulation jumps from one predicted
+        event to the next: particle-particle collisions, particle-wall collisions and particles
+        crossing into a neighbouring cell. Events wait in a priority queue. Every particle has an
+        invalidation counter that is bumped whenever its velocity or cell changes, events
+        recorded with an old count are skipped when they are popped. Collisions are only
+        predicted between particles in neighbouring cells of a grid at least one diameter wide,
+        cell_size sets its width, by default the mean spacing sqrt(width * height / N).
+
+        Particles move lazily, each one is only brought up to date when it takes part in an
+        event. The ParticleArray in simdata is synced at the end of every step, so get_data
+        writes the same dt grid of snapshots as ParticleDynamics.
+    '''
+    COLLISION = 0
+    WALL = 1
+    CELL = 2
+
+    def __init__(self, size : (float, float), boundary_condition : BoundaryCondition, cell_size = None):
+        if (boundary_condition != BoundaryCondition.REFLECTIVE):
+            raise ValueError("EventDrivenDynamics only supports reflective boundaries")
+        super().__init__(size, boundary_condition, compact=True)
+
+        self.cell_size = cell_size
+        self.time = 0.0
+        self.events = 0
+        self.ready = False
+
+    def add_particle(self, radius : float, position : [float], velocity : [float]):
+        self.ready = False
+        return super().add_particle(radius, position, velocity)
+
+    def place_particles(self, n : int, radius, velocity = (0, 0), region = None, inside = None, seed = None):
+        self.ready = False
+        return super().place_particles(n, radius, velocity, region, inside, seed)
+
+    def initialize(self):
+        '''
+            Builds the cell grid and predicts the first events of every particle.
+            Called automatically after particles are added.
+        '''
+        n = self.simdata.count
+        self.x = self.simdata.positions[:n, 0].tolist()
+        self.y = self.simdata.positions[:n, 1].tolist()
+        self.vx = self.simdata.velocities[:n, 0].tolist()
+        self.vy = self.simdata.velocities[:n, 1].tolist()
+        self.r = self.simdata.radii[:n].tolist()
+        self.tau = [self.time] * n
+        self.counts = [0] * n
+
+        width = self.cell_size
+        if (width is None):
+            # about one particle per cell: narrower cells turn most events into cell crossings in a
+            # dilute gas, wider ones make every prediction check many far away particles
+            width = math.sqrt(self.size[0] * self.size[1] / n) if n > 0 else 0
+        width = max(2 * max(self.r, default=0), width)
+        self.grid = [max(1, int(self.size[p] // width)) if width > 0 else 1 for p in range(2)]
+        self.cell_width = [self.size[p] / self.grid[p] for p in range(2)]
+        self.cells = {}
+        self.cell_of = []
+        for i in range(n):
+            cell = (min(max(int(self.x[i] // self.cell_width[0]), 0), self.grid[0] - 1),
+                    min(max(int(self.y[i] // self.cell_width[1]), 0), self.grid[1] - 1))
+            self.cell_of.append(cell)
+            self.cells.setdefault(cell, set()).add(i)
+
+        self.queue = []
+        for i in range(n):
+            self.predict(i)
+        self.ready = True
+
+    def move(self, i : int, time : float):
+        self.x[i] += self.vx[i] * (time - self.tau[i])
+        self.y[i] += self.vy[i] * (time - self.tau[i])
+        self.tau[i] = time
+
+    def predict(self, i : int):
+        '''
+            Queues the next wall, cell crossing and collision events of particle i,
+            which has to be up to date (tau[i] is the current time).
+        '''
+        now = self.tau[i]
+        count = self.counts[i]
+        x, y, vx, vy, r = self.x[i], self.y[i], self.vx[i], self.vy[i], self.r[i]
+        cell = self.cell_of[i]
+
+        for axis, p, v in ((0, x, vx), (1, y, vy)):
+            if (v > 0):
+                heapq.heappush(self.queue, (now + max((self.size[axis] - r - p) / v, 0), self.WALL, i, axis, count, 0))
+                if (cell[axis] < self.grid[axis] - 1):
+                    edge = (cell[axis] + 1) * self.cell_width[axis]
+                    heapq.heappush(self.queue, (now + max((edge - p) / v, 0), self.CELL, i, axis, count, 0))
+            elif (v < 0):
+                heapq.heappush(self.queue, (now + max((r - p) / v, 0), self.WALL, i, axis, count, 0))
+                if (cell[axis] > 0):
+                    edge = cell[axis] * self.cell_width[axis]
+                    heapq.heappush(self.queue, (now + max((edge - p) / v, 0), self.CELL, i, axis, count, 0))
+
+        for cx in range(cell[0] - 1, cell[0] + 2):
+            for cy in range(cell[1] - 1, cell[1] + 2):
+                for j in self.cells.get((cx, cy), ()):
+                    if (j == i):
+                        continue
+                    dx = self.x[j] + self.vx[j] * (now - self.tau[j]) - x
+                    dy = self.y[j] + self.vy[j] * (now - self.tau[j]) - y
+                    dvx = self.vx[j] - vx
+                    dvy = self.vy[j] - vy
+                    b = dx * dvx + dy * dvy
+                    if (b >= 0):
+                        continue
+                    dvv = dvx ** 2 + dvy ** 2
+                    sigma = r + self.r[j]
+                    d = b ** 2 - dvv * (dx ** 2 + dy ** 2 - sigma ** 2)
+                    if (d < 0):
+                        continue
+                    t = -(b + math.sqrt(d)) / dvv
+                    heapq.heappush(self.queue, (now + max(t, 0), self.COLLISION, i, j, count, self.counts[j]))
+
+    def process(self, event):
+        time, kind, i, j, count_i, count_j = event
+        if (self.counts[i] != count_i or (kind == self.COLLISION and self.counts[j] != count_j)):
+            return
+        self.events += 1
+        self.move(i, time)
+
+        if (kind == self.COLLISION):
+            self.move(j, time)
+            # elastic collision of equal masses, the velocity components along the normal are exchanged
+            dx = self.x[j] - self.x[i]
+            dy = self.y[j] - self.y[i]
+            impulse = (dx * (self.vx[j] - self.vx[i]) + dy * (self.vy[j] - self.vy[i])) / (dx ** 2 + dy ** 2)
+            self.vx[i] += impulse * dx
+            self.vy[i] += impulse * dy
+            self.vx[j] -= impulse * dx
+            self.vy[j] -= impulse * dy
+            self.counts[i] += 1
+            self.counts[j] += 1
+            self.predict(i)
+            self.predict(j)
+        elif (kind == self.WALL):
+            if (j == 0):
+                self.vx[i] = -self.vx[i]
+            else:
+                self.vy[i] = -self.vy[i]
+            self.counts[i] += 1
+            self.predict(i)
+        else:
+            v = self.vx[i] if j == 0 else self.vy[i]
+            old = self.cell_of[i]
+            new = list(old)
+            new[j] += 1 if v > 0 else -1
+            new = tuple(new)
+            self.cells[old].discard(i)
+            self.cells.setdefault(new, set()).add(i)
+            self.cell_of[i] = new
+            self.counts[i] += 1
+            self.predict(i)
+
+    def advance(self, time : float):
+        '''
+            Processes every event up to time and syncs simdata to the positions at time.
+        '''
+        if (not self.ready):
+            self.initialize()
+        while (self.queue and self.queue[0][0] <= time):
+            self.process(heapq.heappop(self.queue))
+        self.time = time
+
+        n = self.simdata.count
+        elapsed = time - np.array(self.tau)
+        self.simdata.velocities[:n, 0] = self.vx
+        self.simdata.velocities[:n, 1] = self.vy
+        self.simdata.positions[:n, 0] = np.array(self.x) + self.simdata.velocities[:n, 0] * elapsed
+        self.simdata.positions[:n, 1] = np.array(self.y) + self.simdata.velocities[:n, 1] * elapsed
+
+    def step(self, dt : float):
+        self.advance(self.time + dt)
+
+    def advance_adaptive(self, dt : float, cfl = .5):
+        raise ValueError("EventDrivenDynamics moves from event to event, it has no adaptive substeps")
 
+    def get_data(self, filename : str, steps : int, dt : float, adaptive = False, cfl = .5, layout = "particle",
+                 checkpoints = None, error = None):
+        if (adaptive):
+            raise ValueError("EventDrivenDynamics moves from event to event, it has no adaptive substeps")
+        writer = TrajectoryWriter(filename, self.size, steps, dt, self.simdata.count, layout, error=error)
+        self.write_frames(writer, steps, dt, 0, checkpoints)
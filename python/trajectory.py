@@ -0,0 +1,510 @@
+import os
+import struct
+import zlib
+import multiprocessing as mp
+
+import numpy as np
+
+# first line of a time-major text file, particle-major files start straight with the size
+TIME_MAJOR = "# time-major"
+
+# stripped from text trajectories before the numbers are parsed
+PUNCTUATION = str.maketrans("(),", "   ")
+
+# binary files: magic, width, height, steps, dt, particles and dtype, padded to HEADER_SIZE
+# bytes and followed by the (frames, particles, 2) array in C order
+BINARY_MAGIC = b"DIFFTRJ1"
+BINARY_HEADER = struct.Struct("<8sddqdq8s")
+HEADER_SIZE = 64
+
+# compressed files: magic, width, height, steps, dt, particles, error and chunk frames, then the
+# zlib compressed chunks, the chunk index and a footer with the offset of the index and the
+# number of chunks
+COMPRESSED_MAGIC = b"DIFFTRZ1"
+COMPRESSED_HEADER = struct.Struct("<8sddqdqdq")
+COMPRESSED_FOOTER = struct.Struct("<qq")
+# first frame, frames, offset, length and delta itemsize of every chunk
+INDEX_COLUMNS = 5
+
+def format_points(points) -> str:
+    '''
+        Formats an (n, 2) array as "(x,y) (x,y) ... " with one string formatting call, the
+        numbers are written like str(float) so the output matches the original writer.
+    '''
+    points = np.asarray(points, dtype=float)
+    return ("(%r,%r) " * len(points)) % tuple(points.ravel().tolist())
+
+def write_header(f, size : (float, float), steps : int, dt : float, particles : int):
+    f.write(str(size[0]) + " " + str(size[1]) + "\n")
+    f.write(str(steps) + " " + str(dt) + "\n")
+    f.write(str(particles) + "\n")
+
+def write_particle_major(f, frames, budget = 1 << 20, piece = 1 << 16):
+    '''
+        Writes the (T, N, 2) frames one line per particle. frames[:, a:b] is read for as many
+        particles as fit in budget points at a time, a line longer than budget points is read as
+        frames[t:t + budget, p]. Lines are formatted piece points at a time, so memory depends on
+        neither T nor N and frames can be a file much larger than RAM (see TransposedFrames).
+    '''
+    steps, particles = frames.shape[:2]
+    block = max(1, budget // max(steps, 1))
+    for start in range(0, particles, block):
+        if (steps > budget):
+            for first in range(0, steps, budget):
+                points = np.asarray(frames[first:first + budget, start])
+                for i in range(0, len(points), piece):
+                    f.write(format_points(points[i:i + piece]))
+            f.write("\n")
+            continue
+        columns = np.asarray(frames[:, start:start + block])
+        for p in range(columns.shape[1]):
+            points = columns[:, p]
+            f.write("".join([format_points(points[i:i + piece]) for i in range(0, steps, piece)]) + "\n")
+
+def write_trajectory(filename : str, size : (float, float), steps : int, dt : float, time_data):
+    '''
+        Writes a (steps + 1, N, 2) array of positions in the particle-major text format
+        described in data/data_format.txt.
+    '''
+    with open(filename, "w") as f:
+        write_header(f, size, steps, dt, time_data.shape[1])
+        write_particle_major(f, time_data)
+
+def write_binary_header(f, size : (float, float), steps : int, dt : float, particles : int, dtype):
+    header = BINARY_HEADER.pack(BINARY_MAGIC, float(size[0]), float(size[1]), int(steps), float(dt),
+                                int(particles), np.dtype(dtype).str.encode())
+    f.write(header.ljust(HEADER_SIZE, b"\0"))
+
+def magic(filename : str) -> bytes:
+    with open(filename, "rb") as f:
+        return f.read(len(BINARY_MAGIC))
+
+def is_binary(filename : str) -> bool:
+    return magic(filename) == BINARY_MAGIC
+
+def read_binary(filename : str):
+    '''
+        Opens a binary trajectory without reading it, returns size, steps, dt and the
+        (frames, N, 2) positions as a read only numpy.memmap.
+    '''
+    with open(filename, "rb") as f:
+        magic, width, height, steps, dt, particles, dtype = BINARY_HEADER.unpack(f.read(BINARY_HEADER.size))
+    dtype = np.dtype(dtype.rstrip(b"\0").decode())
+    # frames that were completely written, a run that was cut short still opens
+    frames = (os.path.getsize(filename) - HEADER_SIZE) // (particles * 2 * dtype.itemsize) if particles > 0 else 0
+    if (frames == 0):
+        return (width, height), steps, dt, np.zeros((0, particles, 2), dtype=dtype)
+    positions = np.memmap(filename, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(frames, particles, 2))
+    return (width, height), steps, dt, positions
+
+def parse_block(text : str):
+    '''
+        Parses any number of "(x,y) " points (over any number of lines) into a flat array of
+        coordinates in one pass.
+    '''
+    tokens = text.translate(PUNCTUATION).split()
+    return np.fromiter(map(float, tokens), dtype=np.float64, count=len(tokens))
+
+def parse_lines(block):
+    '''
+        Parses a (lines, text) block into a (lines, values per line) array.
+    '''
+    lines, text = block
+    values = parse_block(text)
+    if (len(values) % lines != 0):
+        raise ValueError("the lines of a trajectory must all hold the same number of points")
+    return values.reshape(lines, -1)
+
+def text_blocks(f, block_lines : int):
+    '''
+        Yields (lines, text) for consecutive blocks of up to block_lines non empty lines of f.
+    '''
+    lines = []
+    for line in f:
+        if (line.strip()):
+            lines.append(line)
+            if (len(lines) == block_lines):
+                yield len(lines), "".join(lines)
+                lines = []
+    if (len(lines) > 0):
+        yield len(lines), "".join(lines)
+
+def read_text(filename : str, workers = None, block_lines = 256):
+    '''
+        Parses a particle-major or time-major text trajectory, returns size, steps, dt and the
+        (frames, N, 2) positions.
+
+        The lines are parsed in blocks of block_lines straight into one preallocated array, 16
+        bytes per point, a particle-major file fills an (N, frames, 2) array and the positions
+        returned are a transposed view of it. Blocks are spread over workers processes, by
+        default every core for files over 64 MB and only this process otherwise.
+    '''
+    if (workers is None):
+        workers = os.cpu_count() if os.path.getsize(filename) > 64 * 2 ** 20 else 1
+    with open(filename) as f:
+        first = f.readline()
+        time_major = first.strip() == TIME_MAJOR
+        if (time_major):
+            first = f.readline()
+        width, height = first.split()
+        steps, dt = f.readline().split()
+        particles = int(f.readline())
+        size, steps, dt = (float(width), float(height)), int(steps), float(dt)
+
+        # one row per line: a frame of every particle, or every frame of one particle
+        rows = steps + 1 if time_major else particles
+        data = None
+        count = 0
+        blocks = text_blocks(f, block_lines)
+        pool = None
+        if (workers > 1):
+            context = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+            pool = context.Pool(workers)
+            parsed = pool.imap(parse_lines, blocks)
+        else:
+            parsed = map(parse_lines, blocks)
+        try:
+            for values in parsed:
+                if (data is None):
+                    data = np.empty((max(rows, len(values)), values.shape[1]), dtype=np.float64)
+                if (values.shape[1] != data.shape[1]):
+                    raise ValueError("the lines of a trajectory must all hold the same number of points")
+                lines = len(values)
+                if (count + lines > len(data)):
+                    data = np.resize(data, (max(count + lines, 2 * len(data)), data.shape[1]))
+                data[count:count + lines] = values
+                count += lines
+        finally:
+            if (pool is not None):
+                pool.terminate()
+
+    if (data is None):
+        return size, steps, dt, np.zeros((0, particles, 2))
+    data = data[:count].reshape(count, -1, 2)
+    if (not time_major):
+        return size, steps, dt, np.swapaxes(data, 0, 1)
+    return size, steps, dt, data
+
+def encode_chunk(frames, error : float):
+    '''
+        Compresses (k, N, 2) frames: positions are rounded to multiples of 2 * error (so no
+        coordinate moves by more than error, up to float rounding), the first frame is stored whole and the others as
+        integer steps from the previous frame, in the smallest integer type that holds them. The
+        bytes of the steps are grouped by significance (byte shuffle), which leaves long runs of
+        similar bytes for zlib. Returns the bytes and the itemsize of the steps.
+    '''
+    quantized = np.rint(np.asarray(frames, dtype=float) / (2 * error)).astype(np.int64)
+    deltas = np.diff(quantized, axis=0)
+    largest = np.max(np.abs(deltas)) if deltas.size > 0 else 0
+    itemsize = next(size for size in (1, 2, 4, 8) if largest < 2 ** (8 * size - 1))
+    shuffled = deltas.astype("<i" + str(itemsize)).view(np.uint8).reshape(-1, itemsize).T
+    payload = quantized[0].astype("<i8").tobytes() + shuffled.tobytes()
+    return zlib.compress(payload, 6), itemsize
+
+def decode_chunk(data : bytes, frames : int, particles : int, itemsize : int, error : float):
+    raw = zlib.decompress(data)
+    first = np.frombuffer(raw, dtype="<i8", count=particles * 2).reshape(particles, 2)
+    shuffled = np.frombuffer(raw, dtype=np.uint8, offset=particles * 16).reshape(itemsize, -1)
+    deltas = np.ascontiguousarray(shuffled.T).view("<i" + str(itemsize)).reshape(frames - 1, particles, 2)
+    quantized = np.empty((frames, particles, 2), dtype=np.int64)
+    quantized[0] = first
+    np.cumsum(deltas, axis=0, dtype=np.int64, out=quantized[1:])
+    quantized[1:] += first
+    return quantized * (2 * error)
+
+class CompressedFrames:
+    '''
+        The (frames, N, 2) positions of a compressed trajectory, decoded on access.
+
+        Indexing with a frame number or a slice of frames reads and decodes only the chunks that
+        hold those frames, the index of the chunks is read when the file is opened.
+    '''
+    def __init__(self, filename : str):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            header = COMPRESSED_HEADER.unpack(f.read(COMPRESSED_HEADER.size))
+            magic, width, height, self.steps, self.dt, self.particles, self.error, self.chunk = header
+            self.size = (width, height)
+            f.seek(-COMPRESSED_FOOTER.size, os.SEEK_END)
+            offset, chunks = COMPRESSED_FOOTER.unpack(f.read(COMPRESSED_FOOTER.size))
+            f.seek(offset)
+            self.index = np.frombuffer(f.read(chunks * INDEX_COLUMNS * 8), dtype="<i8").reshape(chunks, INDEX_COLUMNS)
+        frames = int(self.index[-1, 0] + self.index[-1, 1]) if chunks > 0 else 0
+        self.shape = (frames, self.particles, 2)
+        self.dtype = np.dtype(np.float64)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read(self, start : int, stop : int):
+        '''
+            Decodes frames start to stop (exclusive).
+        '''
+        if (stop <= start):
+            return np.zeros((0, self.particles, 2))
+        first = np.searchsorted(self.index[:, 0], start, side="right") - 1
+        last = np.searchsorted(self.index[:, 0], stop - 1, side="right") - 1
+        decoded = []
+        with open(self.filename, "rb") as f:
+            for begin, frames, offset, length, itemsize in self.index[first:last + 1].tolist():
+                f.seek(offset)
+                decoded.append(decode_chunk(f.read(length), frames, self.particles, itemsize, self.error))
+        begin = self.index[first, 0]
+        return np.concatenate(decoded)[start - begin:stop - begin]
+
+    def __getitem__(self, key):
+        if (isinstance(key, slice)):
+            start, stop, step = key.indices(len(self))
+            if (step < 0):
+                return self.read(stop + 1, start + 1)[::step]
+            return self.read(start, stop)[::step]
+        if (key < 0):
+            key += len(self)
+        if (key < 0 or key >= len(self)):
+            raise IndexError("frame " + str(key) + " out of range")
+        return self.read(key, key + 1)[0]
+
+    def __array__(self, dtype = None, copy = None):
+        return self.read(0, len(self)) if dtype is None else self.read(0, len(self)).astype(dtype)
+
+def read_compressed(filename : str):
+    '''
+        Opens a compressed trajectory, returns size, steps, dt and its CompressedFrames.
+    '''
+    frames = CompressedFrames(filename)
+    return frames.size, frames.steps, frames.dt, frames
+
+def read_trajectory(filename : str):
+    '''
+        Reads a trajectory in any of the formats, returns size, steps, dt and the (frames, N, 2)
+        positions. Binary files are memory mapped and compressed ones decoded only where they
+        are indexed (CompressedFrames), text files are parsed whole.
+    '''
+    kind = magic(filename)
+    if (kind == BINARY_MAGIC):
+        return read_binary(filename)
+    if (kind == COMPRESSED_MAGIC):
+        return read_compressed(filename)
+    return read_text(filename)
+
+def transpose_frames(source : str, target : str, frames : int, particles : int, budget = 1 << 20):
+    '''
+        Rewrites a headerless float64 file of (frames, N, 2) positions particle by particle as
+        (N, frames, 2). The source is read once, budget points worth of frames at a time, and
+        every particle's part of such a tile is written with one write into its run of the
+        target, so each file is read or written once whatever its size.
+    '''
+    rows = max(1, budget // max(particles, 1))
+    with open(source, "rb") as f, open(target, "wb") as out:
+        out.truncate(frames * particles * 16)
+        for first in range(0, frames, rows):
+            count = min(rows, frames - first)
+            tile = np.fromfile(f, dtype=np.float64, count=count * particles * 2).reshape(count, particles, 2)
+            columns = np.ascontiguousarray(np.swapaxes(tile, 0, 1))
+            for p in range(particles):
+                out.seek((p * frames + first) * 16)
+                out.write(columns[p].tobytes())
+
+class TransposedFrames:
+    '''
+        (frames, N, 2) float64 positions stored particle after particle, (N, frames, 2), in a
+        headerless file (see transpose_frames). It is sliced like the array by
+        write_particle_major, all frames of a range of particles (frames[:, a:b]) or a range of
+        frames of one particle (frames[t0:t1, p]), both are one contiguous read from the file.
+    '''
+    def __init__(self, filename : str, frames : int, particles : int):
+        self.filename = filename
+        self.shape = (frames, particles, 2)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        times, columns = key
+        frames, particles = self.shape[:2]
+        first, last, stride = times.indices(frames)
+        assert stride == 1
+        if (isinstance(columns, slice)):
+            start, stop, stride = columns.indices(particles)
+            assert stride == 1 and first == 0 and last == frames
+            count = max(stop - start, 0)
+            data = np.fromfile(self.filename, dtype=np.float64, count=count * frames * 2,
+                               offset=start * frames * 16)
+            return np.swapaxes(data.reshape(count, frames, 2), 0, 1)
+        return np.fromfile(self.filename, dtype=np.float64, count=max(last - first, 0) * 2,
+                           offset=(columns * frames + first) * 16).reshape(-1, 2)
+
+class TrajectoryWriter:
+    '''
+        Writes the frames of a run to a trajectory file while it is produced.
+
+        layout = "time" writes the time-major text format (a "# time-major" line, the usual
+        header, then one line of N points per frame). Frames are collected in a buffer of block
+        frames which is formatted and flushed in one go, so memory does not grow with the number
+        of steps. layout = "particle" writes the particle-major format of data_format.txt, which
+        can only be written once the run is over, so the frames are spooled block by block to a
+        scratch file next to filename, which close() transposes on disk and turns into text.
+        layout = "binary" writes the binary format (see read_binary) block by block, dtype sets
+        its precision.
+        layout = "compressed" writes every block as one chunk of the compressed format (see
+        encode_chunk), positions are kept to within error, by default a millionth of the box.
+
+        Frames are passed to write(positions) or written in place into next_frame().
+    '''
+    def __init__(self, filename : str, size : (float, float), steps : int, dt : float, particles : int,
+                 layout = "particle", block = 64, dtype = np.float64, error = None):
+        if (layout not in ("particle", "time", "binary", "compressed")):
+            raise ValueError("layout must be particle, time, binary or compressed")
+        self.filename = filename
+        self.size = size
+        self.steps = steps
+        self.dt = dt
+        self.particles = particles
+        self.layout = layout
+        self.count = 0
+
+        if (layout == "time"):
+            self.file = open(filename, "w")
+            self.file.write(TIME_MAJOR + "\n")
+            write_header(self.file, size, steps, dt, particles)
+            self.buffer = np.empty((block, particles, 2))
+            self.buffered = 0
+        elif (layout == "binary"):
+            self.file = open(filename, "wb")
+            write_binary_header(self.file, size, steps, dt, particles, dtype)
+            self.buffer = np.empty((block, particles, 2), dtype=dtype)
+            self.buffered = 0
+        elif (layout == "compressed"):
+            self.error = error if error is not None else 1e-6 * max(float(size[0]), float(size[1]))
+            self.file = open(filename, "wb")
+            self.file.write(COMPRESSED_HEADER.pack(COMPRESSED_MAGIC, float(size[0]), float(size[1]), int(steps),
+                                                   float(dt), int(particles), self.error, int(block)))
+            self.buffer = np.empty((block, particles, 2))
+            self.buffered = 0
+            self.index = []
+        else:
+            self.spool = filename + ".frames"
+            self.file = open(self.spool, "wb")
+            self.buffer = np.empty((block, particles, 2))
+            self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if (exc_type is None):
+            self.close()
+        else:
+            # leave the file as it is so that the run can be resumed from a checkpoint
+            self.file.close()
+
+    def __getstate__(self):
+        # the open file is replaced by how much of it was written and the frame buffer by its
+        # length, dtype and the frames not flushed yet (none after write_frames flushed), see __setstate__
+        state = dict(self.__dict__)
+        state.pop("file")
+        state["offset"] = self.file.tell()
+        state["buffer"] = (len(self.buffer), self.buffer.dtype, self.buffer[:self.buffered].copy())
+        return state
+
+    def __setstate__(self, state):
+        '''
+            Reopens the file of a writer restored from a checkpoint, anything written after the
+            checkpoint is cut off.
+        '''
+        offset = state.pop("offset", None)
+        self.__dict__.update(state)
+        if (self.layout == "particle"):
+            os.truncate(self.spool, offset)
+            self.file = open(self.spool, "ab")
+        else:
+            os.truncate(self.filename, offset)
+            self.file = open(self.filename, "a" if self.layout == "time" else "ab")
+        block, dtype, buffered = self.buffer
+        self.buffer = np.empty((block, self.particles, 2), dtype=dtype)
+        self.buffer[:len(buffered)] = buffered
+
+    def next_frame(self):
+        '''
+            Returns the (N, 2) array of the next frame to be filled in place.
+        '''
+        if (self.buffered == len(self.buffer)):
+            self.flush()
+        self.count += 1
+        self.buffered += 1
+        return self.buffer[self.buffered - 1]
+
+    def write(self, positions):
+        self.next_frame()[...] = positions
+
+    def flush(self):
+        if (self.layout == "time" and self.buffered > 0):
+            self.file.write("".join([format_points(frame) + "\n" for frame in self.buffer[:self.buffered]]))
+        elif (self.layout in ("binary", "particle") and self.buffered > 0):
+            self.file.write(self.buffer[:self.buffered].tobytes())
+        elif (self.layout == "compressed" and self.buffered > 0):
+            data, itemsize = encode_chunk(self.buffer[:self.buffered], self.error)
+            self.index.append((self.count - self.buffered, self.buffered, self.file.tell(), len(data), itemsize))
+            self.file.write(data)
+        self.buffered = 0
+        self.file.flush()
+
+    def close(self):
+        if (self.file.closed):
+            return
+        self.flush()
+        if (self.layout == "compressed"):
+            offset = self.file.tell()
+            self.file.write(np.array(self.index, dtype="<i8").reshape(-1, INDEX_COLUMNS).tobytes())
+            self.file.write(COMPRESSED_FOOTER.pack(offset, len(self.index)))
+        self.file.close()
+        if (self.layout == "particle"):
+            # the frames are transposed on disk once, then every line is read in one piece
+            transposed = self.filename + ".particles"
+            transpose_frames(self.spool, transposed, self.count, self.particles)
+            os.remove(self.spool)
+            with open(self.filename, "w") as f:
+                write_header(f, self.size, self.steps, self.dt, self.particles)
+                write_particle_major(f, TransposedFrames(transposed, self.count, self.particles))
+            os.remove(transposed)
+
+def parse_points(line : str):
+    '''
+        Parses a line of "(x,y) " points into an (n, 2) array.
+    '''
+    return parse_block(line).reshape(-1, 2)
+
+def to_particle_major(source : str, target : str):
+    '''
+        Converts a time-major text trajectory into the particle-major format of data_format.txt.
+        The frames go through a scratch file, memory stays independent of the number of steps.
+    '''
+    with open(source) as f:
+        if (f.readline().strip() != TIME_MAJOR):
+            raise ValueError(source + " is not a time-major trajectory")
+        width, height = f.readline().split()
+        steps, dt = f.readline().split()
+        particles = int(f.readline())
+        with TrajectoryWriter(target, (width, height), int(steps), dt, particles) as writer:
+            for line in f:
+                if (line.strip()):
+                    writer.write(parse_points(line))
+
+def convert(source : str, target : str, layout = "binary", dtype = np.float64, block = 64, error = None):
+    '''
+        Converts a trajectory in any format into layout ("particle", "time", "binary" or
+        "compressed"), block frames at a time.
+    '''
+    size, steps, dt, positions = read_trajectory(source)
+    with TrajectoryWriter(target, size, steps, dt, positions.shape[1], layout, block, dtype, error) as writer:
+        for start in range(0, len(positions), block):
+            for frame in positions[start:start + block]:
+                writer.write(frame)
+
+# $ python trajectory.py <source> <target> <particle/time/binary/compressed>
+if __name__ == '__main__':
+    import sys
+    if (len(sys.argv) != 4):
+        print("Improper Number of commandline arguments: $ python trajectory.py <source> <target> <particle/time/binary/compressed>")
+    else:
+        convert(sys.argv[1], sys.argv[2], sys.argv[3])